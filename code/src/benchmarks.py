@@ -0,0 +1,324 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as splinalg
+
+import quadtree
+import geometry as geo
+import fem
+import multigrid as mg
+
+
+def is_dirichlet(vertex):
+    return vertex[1] > 1.0 - 1e-8
+
+
+def eval_k(x, y):
+    return 1.0 + 0.5 * np.sin(4 * x) * np.cos(3 * y)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def split_recursively(level):
+    # The old path: one recursive split of the whole tree per level.
+    grid = quadtree.Quadtree(center=np.array([0.5, 0.5]), size=1.0)
+    for _ in range(level):
+        grid.split()
+    return grid
+
+
+def benchmark_build(levels):
+    print("Building the quadtree (seconds)")
+    print("{:>5} {:>10} {:>12} {:>12} {:>12}".format(
+        "level", "cells", "split()", "Quadtree", "Compact"))
+    for level in levels:
+        t_split, _ = timed(split_recursively, level)
+        t_tree, _ = timed(quadtree.Quadtree(center=np.array([0.5, 0.5]), size=1.0).split_to_level, level)
+        t_compact, _ = timed(quadtree.CompactQuadtree(center=np.array([0.5, 0.5]), size=1.0).split_to_level, level)
+        print("{:>5} {:>10} {:>12.4f} {:>12.4f} {:>12.4f}".format(
+            level, sum(4**l for l in range(level + 1)), t_split, t_tree, t_compact))
+
+    print("Building the geometry (seconds)")
+    print("{:>5} {:>12} {:>12} {:>12} {:>12}".format("level", "Quadtree", "Compact", "Lazy", "Lazy 0..3"))
+    for level in levels:
+        t_tree, _ = timed(geo.Geometry, level, is_dirichlet)
+        t_compact, _ = timed(geo.Geometry, level, is_dirichlet, compact=True)
+        t_lazy, _ = timed(lambda: geo.Geometry(level, is_dirichlet, lazy=True).data_size_per_level[-1])
+        t_coarse, _ = timed(lambda: geo.Geometry(level, is_dirichlet, lazy=True).data_size_per_level[3])
+        print("{:>5} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f}".format(level, t_tree, t_compact, t_lazy, t_coarse))
+
+
+def setup_stiffness_loop(discretization, useDir=False):
+    # The old assembly: one += into a lil_matrix per cell, pair of basis
+    # functions and quadrature point.
+    d = discretization
+    n = d.number_of_vertices if useDir else d.number_of_data
+    stiffness = sp.lil_matrix((n, n), dtype=np.float64)
+    grid = d.geometry.grid
+    for center, vertices in zip(grid.level_centers(d.level), grid.level_vertices(d.level)):
+        for lin_0, vertex_0 in enumerate(vertices):
+            for lin_1, vertex_1 in enumerate(vertices):
+                data_0 = d.geometry.vertex_idx_to_data_idx[vertex_0]
+                data_1 = d.geometry.vertex_idx_to_data_idx[vertex_1]
+                if vertex_0 in d.geometry.dirichlet_vertices:
+                    if useDir:
+                        stiffness[vertex_0, :] = 0
+                    continue
+                if not useDir and vertex_1 in d.geometry.dirichlet_vertices:
+                    continue
+                for lin_quad in range(4):
+                    quad_i, quad_j = fem.lin2cart(lin_quad)
+                    quad_coords = np.array([d.quad_x[quad_i], d.quad_x[quad_j]])
+                    quad_weight = d.quad_w[quad_i] * d.quad_w[quad_j]
+                    diff_x = fem.lagrange_2d_diffx(d.nodes_x, lin_0, quad_coords) * \
+                        fem.lagrange_2d_diffx(d.nodes_x, lin_1, quad_coords)
+                    diff_y = fem.lagrange_2d_diffy(d.nodes_x, lin_0, quad_coords) * \
+                        fem.lagrange_2d_diffy(d.nodes_x, lin_1, quad_coords)
+                    factor = d.area_reference_cell * quad_weight * d.eval_k(center[0], center[1])
+                    if useDir:
+                        stiffness[vertex_0, vertex_1] += factor * (diff_x + diff_y)
+                    else:
+                        stiffness[data_0, data_1] += factor * (diff_x + diff_y)
+    return stiffness.tocsc()
+
+
+def is_identical(a, b):
+    return (a.shape == b.shape and np.array_equal(a.indptr, b.indptr)
+            and np.array_equal(a.indices, b.indices) and np.array_equal(a.data, b.data))
+
+
+def benchmark_stiffness(levels, max_loop_level):
+    print("Assembling the stiffness matrix (seconds)")
+    print("{:>5} {:>10} {:>12} {:>12} {:>10}".format("level", "nnz", "loop", "vectorized", "identical"))
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        discretization = fem.Discretization(geometry, level, eval_k)
+        t_vectorized, stiffness = timed(discretization.setup_stiffness)
+        if level <= max_loop_level:
+            t_loop, reference = timed(setup_stiffness_loop, discretization)
+            print("{:>5} {:>10} {:>12.4f} {:>12.4f} {:>10}".format(
+                level, stiffness.nnz, t_loop, t_vectorized, str(is_identical(stiffness, reference))))
+        else:
+            print("{:>5} {:>10} {:>12} {:>12.4f} {:>10}".format(level, stiffness.nnz, "-", t_vectorized, "-"))
+
+
+def matvec_throughput(operator, x, repeat):
+    # Products per second
+    seconds, _ = timed(lambda: [operator @ x for _ in range(repeat)])
+    return repeat / seconds
+
+
+def benchmark_matvec(levels, repeat=20):
+    print("Stiffness matrix against the matrix-free operator")
+    print("{:>5} {:>10} {:>12} {:>12} {:>12} {:>12} {:>10}".format(
+        "level", "unknowns", "CSR MB", "free MB", "CSR mv/s", "free mv/s", "rel. diff"))
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        discretization = fem.Discretization(geometry, level, eval_k)
+        stiffness = discretization.setup_stiffness().tocsr()
+        operator = discretization.stiffness_operator()
+        x = np.random.default_rng(level).random(stiffness.shape[1])
+        csr_bytes = stiffness.data.nbytes + stiffness.indices.nbytes + stiffness.indptr.nbytes
+        difference = np.abs(operator @ x - stiffness @ x).max() / np.abs(stiffness @ x).max()
+        print("{:>5} {:>10} {:>12.3f} {:>12.3f} {:>12.1f} {:>12.1f} {:>10.1e}".format(
+            level, stiffness.shape[0], csr_bytes / 1e6, operator.nbytes / 1e6,
+            matvec_throughput(stiffness, x, repeat), matvec_throughput(operator, x, repeat), difference))
+
+
+def benchmark_degree(levels, degrees=(1, 2, 3), repeat=20):
+    print("Elements of higher degree: assembly (seconds) and products per second")
+    print("{:>5} {:>6} {:>10} {:>12} {:>12} {:>12}".format(
+        "level", "degree", "unknowns", "assembly", "CSR mv/s", "free mv/s"))
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        for degree in degrees:
+            discretization = fem.Discretization(geometry, level, eval_k, degree=degree)
+            t_assembly, stiffness = timed(discretization.setup_stiffness)
+            stiffness = stiffness.tocsr()
+            operator = discretization.stiffness_operator()
+            x = np.random.default_rng(level).random(stiffness.shape[1])
+            print("{:>5} {:>6} {:>10} {:>12.4f} {:>12.1f} {:>12.1f}".format(
+                level, degree, stiffness.shape[0], t_assembly,
+                matvec_throughput(stiffness, x, repeat), matvec_throughput(operator, x, repeat)))
+
+
+def benchmark_sweep(levels, samples=10):
+    print("Coefficient sweep, seconds per sample")
+    print("{:>5} {:>10} {:>12} {:>12} {:>12}".format("level", "nnz", "pattern", "assembly", "refill"))
+    rng = np.random.default_rng(0)
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        discretization = fem.Discretization(geometry, level, eval_k)
+        coefficients = 1.0 + rng.random((samples, 4**level))
+        t_pattern, _ = timed(discretization.stiffness_pattern)
+        stiffness = discretization.refill_stiffness()
+
+        def assemble_all():
+            for k in coefficients:
+                # Stand in for the cached values of eval_k
+                discretization.coefficients["centers"] = k[:, None]
+                discretization.setup_stiffness()
+
+        def refill_all():
+            for k in coefficients:
+                discretization.refill_stiffness(out=stiffness, k=k)
+
+        t_assembly, _ = timed(assemble_all)
+        t_refill, _ = timed(refill_all)
+        print("{:>5} {:>10} {:>12.4f} {:>12.4f} {:>12.4f}".format(
+            level, stiffness.nnz, t_pattern, t_assembly / samples, t_refill / samples))
+
+
+def benchmark_parallel(levels, workers=(1, 2, 4)):
+    print("Parallel assembly over chunks of cells (seconds)")
+    print("{:>5} {:>12}".format("level", "serial") + "".join("{:>12}".format("{} workers".format(w)) for w in workers))
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        discretization = fem.Discretization(geometry, level, eval_k)
+        t_serial, _ = timed(discretization.setup_stiffness)
+        times = []
+        results = []
+        for w in workers:
+            t, stiffness = timed(discretization.setup_stiffness_parallel, workers=w)
+            times.append(t)
+            results.append(stiffness)
+        assert all(is_identical(results[0], stiffness) for stiffness in results)
+        print("{:>5} {:>12.4f}".format(level, t_serial) + "".join("{:>12.4f}".format(t) for t in times))
+
+
+def benchmark_hierarchy(levels):
+    for coarsening in ("rediscretization", "galerkin"):
+        geometry = geo.Geometry(max(levels), is_dirichlet, compact=True)
+        hierarchy = mg.build_hierarchy(geometry, min(levels), max(levels), eval_k, coarsening=coarsening)
+        print(hierarchy.summary())
+
+
+def benchmark_solvers(levels, tolerance=1e-8):
+    print("Multigrid-preconditioned CG: iterations and seconds per solve")
+    print("{:>5} {:>10} {:>10} {:>10} {:>6} {:>6} {:>6} {:>10} {:>10}".format(
+        "level", "unknowns", "smoother", "method", "cycle", "nu", "iter", "setup", "solve"))
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        discretization = fem.Discretization(geometry, level, eval_k)
+        stiffness = discretization.setup_stiffness().tocsr()
+        rhs = discretization.setup_rhs()
+        t_direct, _ = timed(splinalg.spsolve, stiffness.tocsc(), rhs)
+        print("{:>5} {:>10} {:>10} {:>10} {:>6} {:>6} {:>6} {:>10} {:>10.4f}".format(
+            level, stiffness.shape[0], "-", "spsolve", "-", "-", "-", "-", t_direct))
+        for smoother in ("jacobi", "chebyshev"):
+            t_setup, storage = timed(mg.MultigridStorage, discretization, 1, level, stiffness, smoother=smoother)
+            for flexible in (False, True):
+                for cycle_type in mg.CYCLES:
+                    for smoothing in (1, 2):
+                        _, statistics = mg.cg(storage, rhs, tolerance=tolerance, flexible=flexible,
+                                              cycle_type=cycle_type, pre_smoothing=smoothing,
+                                              post_smoothing=smoothing)
+                        print("{:>5} {:>10} {:>10} {:>10} {:>6} {:>6} {:>6} {:>10.4f} {:>10.4f}".format(
+                            level, stiffness.shape[0], smoother, "FCG" if flexible else "CG", cycle_type,
+                            smoothing, statistics["iterations"], t_setup, statistics["time"]))
+
+
+def benchmark_fmg(levels):
+    print("Full multigrid against V-cycles from a zero guess (seconds)")
+    print("Errors are max norms against spsolve, 'discr.' is the change to the solution of the level below")
+    print("{:>5} {:>10} {:>12} {:>10} {:>12} {:>10} {:>12} {:>10} {:>10}".format(
+        "level", "unknowns", "multigrid", "error", "FMG 1", "error", "FMG 2", "error", "discr."))
+    geometry = geo.Geometry(max(levels), is_dirichlet, compact=True)
+    for level in levels:
+        discretization = fem.Discretization(geometry, level, eval_k)
+        stiffness = discretization.setup_stiffness().tocsr()
+        rhs = discretization.setup_rhs()
+        solution = splinalg.spsolve(stiffness.tocsc(), rhs)
+        storage = mg.MultigridStorage(discretization, 1, level, stiffness)
+        coarse_discretization = fem.Discretization(geometry, level - 1, eval_k)
+        coarse_solution = splinalg.spsolve(coarse_discretization.setup_stiffness(), coarse_discretization.setup_rhs())
+        discretization_error = np.abs(storage.coarse_to_fine[-1] @ coarse_solution - solution).max()
+
+        t_loop, (unknowns, _) = timed(mg.multigrid, storage, rhs)
+        t_fmg_1, fmg_1 = timed(mg.full_multigrid, storage, rhs, cycles_per_level=1)
+        t_fmg_2, fmg_2 = timed(mg.full_multigrid, storage, rhs, cycles_per_level=2)
+        print("{:>5} {:>10} {:>12.4f} {:>10.1e} {:>12.4f} {:>10.1e} {:>12.4f} {:>10.1e} {:>10.1e}".format(
+            level, stiffness.shape[0], t_loop, np.abs(unknowns - solution).max(),
+            t_fmg_1, np.abs(fmg_1 - solution).max(), t_fmg_2, np.abs(fmg_2 - solution).max(), discretization_error))
+
+
+def v_cycle_unfused(storage, level, rhs, unknowns):
+    # The old V-cycle: every smoother and the restriction compute their own
+    # residuals.
+    level_index = level - storage.level_min
+    stiffness = storage.operators[level_index]
+    unknowns, _ = storage.smooth(level, rhs, unknowns, 5)
+    if level != storage.level_min:
+        rhs_coarse = storage.fine_to_coarse[level_index] @ (rhs - stiffness @ unknowns)
+        update = v_cycle_unfused(storage, level - 1, rhs_coarse, np.zeros(rhs_coarse.shape[0]))
+        unknowns = unknowns + storage.coarse_to_fine[level_index] @ update
+    return storage.smooth(level, rhs, unknowns, 5)[0]
+
+
+def multigrid_unfused(storage, rhs, tolerance=1e-6, max_cycles=100):
+    unknowns = np.zeros(rhs.shape[0])
+    for cycle in range(max_cycles):
+        if mg.compute_residual(storage.operators[-1], unknowns, rhs) < tolerance:
+            break
+        unknowns = v_cycle_unfused(storage, storage.level_max, rhs, unknowns)
+    return unknowns, cycle
+
+
+def benchmark_spmv(levels):
+    print("Products with the stiffness matrices per V-cycle of multigrid(), per level from the finest")
+    print("{:>5} {:>8} {:>8} {:>10} {:>10}  {}".format("level", "cycles", "fused", "seconds", "total", "per level"))
+    for level in levels:
+        geometry = geo.Geometry(level, is_dirichlet, compact=True)
+        discretization = fem.Discretization(geometry, level, eval_k)
+        stiffness = discretization.setup_stiffness()
+        rhs = discretization.setup_rhs()
+        storage = mg.MultigridStorage(discretization, 1, level, stiffness)
+        for fused, solve in ((False, multigrid_unfused), (True, mg.multigrid)):
+            storage.reset_spmv()
+            seconds, (_, cycles) = timed(solve, storage, rhs)
+            spmv = storage.spmv[::-1] / cycles
+            print("{:>5} {:>8} {:>8} {:>10.4f} {:>10.2f}  {}".format(
+                level, cycles, str(fused), seconds, spmv.sum(), " ".join("{:.2f}".format(s) for s in spmv)))
+
+
+BENCHMARKS = {
+    "build": lambda args: benchmark_build(args.levels),
+    "stiffness": lambda args: benchmark_stiffness(args.levels, args.max_loop_level),
+    "matvec": lambda args: benchmark_matvec(args.levels),
+    "degree": lambda args: benchmark_degree(args.levels),
+    "sweep": lambda args: benchmark_sweep(args.levels),
+    "parallel": lambda args: benchmark_parallel(args.levels),
+    "hierarchy": lambda args: benchmark_hierarchy(args.levels),
+    "solvers": lambda args: benchmark_solvers(args.levels),
+    "fmg": lambda args: benchmark_fmg(args.levels),
+    "spmv": lambda args: benchmark_spmv(args.levels),
+}
+
+
+def main(name, *argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the quadtree finite element code")
+    parser.add_argument("--levels", type=int, nargs="+", default=[4, 5, 6, 7, 8],
+                        help="Levels of refinement to run")
+    parser.add_argument("--max-loop-level", type=int, default=6,
+                        help="Deepest level to run the (slow) loop implementations on")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run, all by default: " + ", ".join(BENCHMARKS))
+    args, _ = parser.parse_known_args(args=argv)
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(benchmark))
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    for benchmark in args.benchmarks:
+        BENCHMARKS[benchmark](args)
+
+
+if __name__ == "__main__":
+    main(*sys.argv)
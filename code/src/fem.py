@@ -1,3 +1,6 @@
+from concurrent import futures
+from multiprocessing import shared_memory
+
 import numpy as np
 import scipy.special as special
 import scipy.sparse as sp
@@ -21,16 +24,16 @@ def area(cell):
 
 def lagrange(points, i, x):
     node = points[i]
-    value = 1.0
+    value = np.ones(np.shape(x))
     for (j, point) in enumerate(points):
         if i != j:
             value *= (x - point) / (node - point)
-    return value
+    return value[()]
 
 def lagrange_diff(points, i, x):
-    result = 0.0
+    result = np.zeros(np.shape(x))
     for j in range(len(points)):
-        acc = 1.0
+        acc = np.ones(np.shape(x))
         if i == j:
             continue
         frac = 1.0 / (points[i] - points[j])
@@ -39,33 +42,215 @@ def lagrange_diff(points, i, x):
                 continue
             acc *= (x - points[m])/(points[i] - points[m])
         result += frac * acc
-    return result
+    return result[()]
 
-def lin2cart(linear_index):
-    i = linear_index // 2
-    j = linear_index % 2
+def lin2cart(linear_index, number_of_nodes=2):
+    i = linear_index // number_of_nodes
+    j = linear_index % number_of_nodes
     return i,j
 
+# The 2d basis functions take a point or an array of points with the
+# coordinates in the last axis.
 def lagrange_2d(points, linear_index, x):
-    i, j = lin2cart(linear_index)
-    return lagrange(points, i, x[0]) * lagrange(points, j, x[1])
+    i, j = lin2cart(linear_index, len(points))
+    x = np.asarray(x)
+    return lagrange(points, i, x[..., 0]) * lagrange(points, j, x[..., 1])
 
 def lagrange_2d_diffx(points, linear_index, x):
-    i, j = lin2cart(linear_index)
-    return lagrange_diff(points, i, x[0]) * lagrange(points, j, x[1])
+    i, j = lin2cart(linear_index, len(points))
+    x = np.asarray(x)
+    return lagrange_diff(points, i, x[..., 0]) * lagrange(points, j, x[..., 1])
 
 def lagrange_2d_diffy(points, linear_index, x):
-    i, j = lin2cart(linear_index)
-    return lagrange(points, i, x[0]) * lagrange_diff(points, j, x[1])    
+    i, j = lin2cart(linear_index, len(points))
+    x = np.asarray(x)
+    return lagrange(points, i, x[..., 0]) * lagrange_diff(points, j, x[..., 1])
+
+
+def tabulate(nodes, points, derivative=None):
+    """Basis functions of the reference cell at the (n, 2) reference points,
+    shape (n, number of basis functions). With derivative 0 or 1 their
+    derivative in x or y.
+    """
+    nodes = np.asarray(nodes, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    basis = {None: lagrange_2d, 0: lagrange_2d_diffx, 1: lagrange_2d_diffy}[derivative]
+    return np.stack([basis(nodes, lin, points) for lin in range(len(nodes)**2)], axis=-1)
+
+
+class Tabulation:
+    """Basis of the reference cell at the points of a tensor product
+    Gauss-Legendre rule, in the order of lin2cart.
+
+    values[q, lin] and gradients[q, lin, d] are the basis functions and
+    their derivatives at quadrature point q, with weight weights[q]. The
+    1d factors of the basis are values_1d[q, i] and derivatives_1d[q, i]
+    at the 1d quadrature points with weights weights_1d[q].
+    """
+    def __init__(self, nodes, number_of_quad_points):
+        self.nodes = np.asarray(nodes, dtype=np.float64)
+        quad_x, quad_w = special.roots_legendre(n=number_of_quad_points)
+        quad_i, quad_j = lin2cart(np.arange(number_of_quad_points**2), number_of_quad_points)
+        self.points = np.stack([quad_x[quad_i], quad_x[quad_j]], axis=-1)
+        self.weights = quad_w[quad_i] * quad_w[quad_j]
+        self.weights_1d = quad_w
+        self.values_1d = np.stack([lagrange(self.nodes, i, quad_x) for i in range(len(self.nodes))], axis=-1)
+        self.derivatives_1d = np.stack([lagrange_diff(self.nodes, i, quad_x) for i in range(len(self.nodes))], axis=-1)
+        self.values = tabulate(self.nodes, self.points)
+        self.gradients = np.stack([tabulate(self.nodes, self.points, 0),
+                                   tabulate(self.nodes, self.points, 1)], axis=-1)
+        # Shared by all callers of tabulation
+        self.values.flags.writeable = False
+        self.gradients.flags.writeable = False
+
+    def at(self, points, derivative=None):
+        # The basis at other reference points, see tabulate. Not cached.
+        return tabulate(self.nodes, points, derivative)
+
+
+_quadrature_tabulations = dict()
+
+def tabulation(nodes, number_of_quad_points):
+    # Tabulation of the basis for the nodes, shared by all callers
+    key = (tuple(np.asarray(nodes, dtype=np.float64).tolist()), number_of_quad_points)
+    if key not in _quadrature_tabulations:
+        _quadrature_tabulations[key] = Tabulation(nodes, number_of_quad_points)
+    return _quadrature_tabulations[key]
+
+
+def assemble(rows, cols, values, shape):
+    """CSR matrix of the sums of the values with the same row and column.
+
+    The values of an entry are summed one after the other in the order they
+    are given, which gives the same result as adding them with += one at a
+    time. Entries that sum to zero are not stored.
+    """
+    n = np.int64(shape[1])
+    keys, sums = sum_duplicates(rows.astype(np.int64) * n + cols, values)
+    nonzero = sums != 0
+    keys = keys[nonzero]
+    return sp.csr_matrix((sums[nonzero], (keys // n, keys % n)), shape=shape)
+
+
+def sum_duplicates(keys, values):
+    # Sorted unique keys and the sums of their values, added one after the
+    # other in the order they are given.
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    values = values[order]
+    is_first = np.ones(len(keys), dtype=bool)
+    is_first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(is_first)
+    counts = np.diff(np.append(starts, len(keys)))
+
+    sums = np.zeros(len(starts))
+    for i in range(counts.max(initial=0)):
+        has_value = counts > i
+        sums[has_value] += values[starts[has_value] + i]
+    return keys[starts], sums
+
+
+def element_values(K, gradients, weights):
+    """Values of the terms of each cell, shape (cells, pairs of basis
+    functions, terms per pair).
+
+    For degree 1 there is one term per quadrature point, in the order the
+    entries were summed by the loop over cells. For higher degrees the
+    quadrature points are summed first, one term per entry of the element
+    matrix.
+    """
+    factor = weights[None, :] * K
+    if gradients.shape[0] == 4:
+        values = factor[:, None, None, :] * gradients[None]
+    else:
+        values = np.einsum("cq,abq->cab", factor, gradients)[..., None]
+    return values.reshape(len(factor), gradients.shape[0]**2, -1)
+
+
+def element_terms(cell_nodes, K, gradients, weights):
+    # Rows, columns and values of the terms of element_values
+    values = element_values(K, gradients, weights)
+    number_of_nodes = cell_nodes.shape[1]
+    rows = np.repeat(cell_nodes, number_of_nodes, axis=1).ravel()
+    cols = np.tile(cell_nodes, number_of_nodes).ravel()
+    return np.repeat(rows, values.shape[-1]), np.repeat(cols, values.shape[-1]), values.ravel()
+
+
+def share(array):
+    # Copy of the array in a new block of shared memory
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str)
+
+
+def attach(name, shape, dtype):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def assemble_chunk(task):
+    """Sum the terms of the cells start:stop of a parallel assembly.
+
+    The unique keys row * n + column of the chunk and their sums are written
+    to the shared output arrays from offset on. Returns their number.
+    """
+    inputs, outputs, start, stop, offset, gradients, weights, n, useDir = task
+    memories = []
+    arrays = []
+    for description in inputs + outputs:
+        memory, array = attach(*description)
+        memories.append(memory)
+        arrays.append(array)
+    cell_nodes, K, node_idx_to_data_idx, out_keys, out_sums = arrays
+    try:
+        rows, cols, values = element_terms(cell_nodes[start:stop], K[start:stop], gradients, weights)
+        data_rows = node_idx_to_data_idx[rows]
+        data_cols = node_idx_to_data_idx[cols]
+        if useDir:
+            # Dirichlet rows are zero
+            keep = data_rows >= 0
+        else:
+            keep = (data_rows >= 0) & (data_cols >= 0)
+            rows, cols = data_rows, data_cols
+        keys, sums = sum_duplicates(rows[keep].astype(np.int64) * n + cols[keep], values[keep])
+        out_keys[offset:offset + len(keys)] = keys
+        out_sums[offset:offset + len(keys)] = sums
+        return len(keys)
+    finally:
+        del cell_nodes, K, node_idx_to_data_idx, out_keys, out_sums, arrays
+        for memory in memories:
+            memory.close()
+
+
+def lobatto_nodes(degree):
+    # Gauss-Lobatto nodes on [-1, 1]: the end points and the roots of the
+    # derivative of the Legendre polynomial of the degree.
+    inner = np.polynomial.legendre.Legendre.basis(degree).deriv().roots()
+    return np.concatenate([[-1.0], np.sort(inner.real), [1.0]])
+
+
+def evaluate_coefficient(eval_k, points, vectorized=False):
+    # Values of eval_k(x, y) at the (..., 2) points
+    if vectorized:
+        values = eval_k(points[..., 0], points[..., 1])
+        return np.broadcast_to(np.asarray(values, dtype=np.float64), points.shape[:-1]).copy()
+    return np.array([eval_k(x, y) for x, y in points.reshape(-1, 2)],
+                    dtype=np.float64).reshape(points.shape[:-1])
 
 
 class Discretization:
-    def __init__(self, geometry, level,  eval_k=None):
-        # Standard linear tensor-prod. basis
-        self.nodes_x = np.array([-1, 1])
+    def __init__(self, geometry, level,  eval_k=None, vectorized_k=False, k_at="centers", degree=1):
+        # Standard linear tensor-prod. basis, or for higher degree the
+        # tensor-prod. basis on the Gauss-Lobatto nodes.
+        self.degree = degree
+        if degree == 1:
+            self.nodes_x = np.array([-1, 1])
+        else:
+            self.nodes_x = lobatto_nodes(degree)
 
         # Gauss-Legendre quadrature
-        self.quad_x, self.quad_w = special.roots_legendre(n=2)
+        self.quad_x, self.quad_w = special.roots_legendre(n=degree + 1)
+        self.tabulation = tabulation(self.nodes_x, len(self.quad_x))
 
         # Ref cell is [-1,1]^2
         self.area_reference_cell = 4
@@ -73,86 +258,470 @@ class Discretization:
         self.geometry = geometry
         self.level = level
 
-        self.number_of_vertices = geometry.number_of_vertices_per_level[level]
-        self.number_of_data = geometry.data_size_per_level[level]
-        self.cur_dirichlet_vertices = set([v for v in geometry.dirichlet_vertices if v < self.number_of_vertices])
+        # The unknowns are the nodes of the elements, for degree 1 these are
+        # the vertices of the grid. cell_nodes holds the nodes of each cell
+        # in the order of lin2cart.
+        if degree != 1:
+            if level is None:
+                raise NotImplementedError("elements of degree > 1 need a uniform level")
+            self.setup_nodes()
+            self.constraints = None
+        elif level is None:
+            # Leaves of an adaptively refined grid
+            self.number_of_vertices = len(geometry.vertex_idx_to_data_idx)
+            self.number_of_data = len(geometry.data_idx_to_vertex_idx)
+            self.setup_constraints()
+        else:
+            self.number_of_vertices = geometry.number_of_vertices_per_level[level]
+            self.number_of_data = geometry.data_size_per_level[level]
+            self.constraints = None
+        if degree == 1:
+            self.cell_nodes = geometry.grid.level_vertices(level)
+            self.node_idx_to_data_idx = geometry.vertex_idx_to_data_idx
+            # Built on first use by node_coordinates
+            self.node_coords = None
+        self.is_dirichlet_node = self.node_idx_to_data_idx[:self.number_of_vertices] < 0
+        self.cur_dirichlet_vertices = set(np.flatnonzero(self.is_dirichlet_node).tolist())
 
+        # eval_k(x, y) is called per point, or once with arrays of x and y
+        # if vectorized_k. The stiffness matrix uses its values at the cell
+        # centers or (k_at="quadrature") at the quadrature points.
         self.eval_k = eval_k
+        self.vectorized_k = vectorized_k
+        self.k_at = k_at
+        self.coefficients = dict()
+        self.coefficient_function = eval_k
+        self.patterns = dict()
 
-    def setup_stiffness(self, useDir=False):
+    def coefficient(self, at="centers"):
+        """Values of eval_k on the cells of the level, shape (cells, 1) at
+        the centers or (cells, quadrature points) at "quadrature".
+
+        They are evaluated once and reused until eval_k is replaced.
+        """
+        if self.coefficient_function is not self.eval_k:
+            self.coefficients = dict()
+            self.coefficient_function = self.eval_k
+        if at not in self.coefficients:
+            if at == "centers":
+                points = self.geometry.grid.level_centers(self.level)[:, None, :]
+            elif at == "quadrature":
+                points = self.quadrature_points()
+            else:
+                raise ValueError("unknown coefficient location {}".format(at))
+            self.coefficients[at] = evaluate_coefficient(self.eval_k, points, self.vectorized_k)
+        return self.coefficients[at]
+
+    def setup_nodes(self):
+        # Number the nodes of the elements of a uniform level. Node (i, j)
+        # of a cell with lattice coordinates (x, y) has the integer
+        # coordinates (degree * x + i, degree * y + j), nodes are numbered
+        # in the order they first appear in the cells.
+        grid = self.geometry.grid
+        centers = grid.level_centers(self.level)
+        sizes = grid.level_sizes(self.level)
+        lattice = np.rint((centers - grid.offset) / sizes[:, None] - 0.5).astype(np.int64)
+        number_of_nodes = len(self.nodes_x)
+        node_i, node_j = lin2cart(np.arange(number_of_nodes**2), number_of_nodes)
+        node_lattice = self.degree * lattice[:, None, :] + np.stack([node_i, node_j], axis=-1)
+        n = self.degree * 2**self.level + 1
+        keys = (node_lattice[..., 0] * n + node_lattice[..., 1]).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(first))
+        self.cell_nodes = rank[inverse].reshape(len(lattice), -1)
+
+        reference = np.stack([self.nodes_x[node_i], self.nodes_x[node_j]], axis=-1)
+        coords = centers[:, None, :] + 0.5 * sizes[:, None, None] * reference
+        self.node_coords = np.empty((len(first), 2))
+        self.node_coords[self.cell_nodes.ravel()] = coords.reshape(-1, 2)
+        lattice = np.empty((len(first), 2), dtype=np.int64)
+        lattice[self.cell_nodes.ravel()] = node_lattice.reshape(-1, 2)
+        on_boundary = np.any((lattice == 0) | (lattice == n - 1), axis=1)
+
+        is_dirichlet = np.zeros(len(first), dtype=bool)
+        for node in np.flatnonzero(on_boundary):
+            is_dirichlet[node] = self.geometry.is_dirichlet(tuple(self.node_coords[node]))
+        self.node_idx_to_data_idx = np.where(is_dirichlet, -1, np.cumsum(~is_dirichlet) - 1)
+        self.number_of_vertices = len(first)
+        self.number_of_data = int(np.sum(~is_dirichlet))
+
+    def setup_constraints(self):
+        # Hanging vertices are not unknowns, their value is the mean of the
+        # two vertices of the coarse edge they lie on. The constraint
+        # matrices map the remaining unknowns to all vertices (useDir=True)
+        # or to all data, where Dirichlet data are zero.
+        hanging, ends = self.geometry.grid.get_hanging_vertices()
+        self.hanging_vertices = hanging
+        self.hanging_ends = ends
+        is_free = np.ones(self.number_of_vertices, dtype=bool)
+        is_free[hanging] = False
+        self.free_vertices = np.flatnonzero(is_free)
+
+        # Triplets in terms of vertices
+        rows = np.concatenate([self.free_vertices, np.repeat(hanging, 2)])
+        cols = np.concatenate([self.free_vertices, ends.ravel()])
+        vals = np.concatenate([np.ones(len(self.free_vertices)), np.full(2 * len(hanging), 0.5)])
+
+        self.constraints = dict()
+        for useDir in (True, False):
+            if useDir:
+                number_of_rows = self.number_of_vertices
+                row_idx = np.arange(self.number_of_vertices)
+                col_vertices = self.free_vertices
+            else:
+                number_of_rows = self.number_of_data
+                row_idx = self.geometry.vertex_idx_to_data_idx
+                col_vertices = self.free_vertices[row_idx[self.free_vertices] >= 0]
+            col_idx = np.full(self.number_of_vertices, -1)
+            col_idx[col_vertices] = np.arange(len(col_vertices))
+            keep = (row_idx[rows] >= 0) & (col_idx[cols] >= 0)
+            self.constraints[useDir] = sp.csr_matrix(
+                (vals[keep], (row_idx[rows[keep]], col_idx[cols[keep]])),
+                shape=(number_of_rows, len(col_vertices)))
+
+    def apply_constraints(self, stiffness, useDir):
+        constraints = self.constraints[useDir]
+        stiffness = (constraints.T @ stiffness @ constraints).tocsr()
         if useDir:
-            stiffness = sp.lil_matrix((self.number_of_vertices, self.number_of_vertices), dtype=np.float64)
-        else:
-            stiffness = sp.lil_matrix((self.number_of_data, self.number_of_data), dtype=np.float64)
-        for cell in self.geometry.grid.dfs(only_level=self.level):
-            for lin_0, vertex_0 in enumerate(cell.vertices):
-                for lin_1, vertex_1 in enumerate(cell.vertices):
-                    data_0 = self.geometry.vertex_idx_to_data_idx[vertex_0]
-                    data_1 = self.geometry.vertex_idx_to_data_idx[vertex_1]
-                    if vertex_0 in self.geometry.dirichlet_vertices:
-                        if useDir:
-                            stiffness[vertex_0, :] = 0
-                            #stiffness[vertex_0,vertex_0] = 1
-                        continue
-                    if not useDir:
-                        if vertex_1 in self.geometry.dirichlet_vertices:
-                        # Dirichlet vertex has zero contribution
-                            continue
-                    for lin_quad in range(4):
-                        quad_i, quad_j = lin2cart(lin_quad)
-                        x, y = self.quad_x[quad_i], self.quad_x[quad_j]
-                        quad_coords = np.array([x, y])
-                        quad_weight = self.quad_w[quad_i] * self.quad_w[quad_j]
-                        diff_x = lagrange_2d_diffx(self.nodes_x, lin_0, quad_coords) * \
-                            lagrange_2d_diffx(self.nodes_x, lin_1, quad_coords)
-                        diff_y = lagrange_2d_diffy(self.nodes_x, lin_0, quad_coords) * \
-                            lagrange_2d_diffy(self.nodes_x, lin_1, quad_coords)
-                        K = self.eval_k(cell.center[0], cell.center[1])
-
-                        factor = self.area_reference_cell * quad_weight * K
-                        if useDir:
-                            stiffness[vertex_0, vertex_1] += factor * (diff_x + diff_y)
-                        else:
-                            stiffness[data_0, data_1] += factor * (diff_x + diff_y)
+            # Dirichlet rows stay zero
+            is_dirichlet = self.geometry.vertex_idx_to_data_idx[self.free_vertices] < 0
+            stiffness = sp.diags((~is_dirichlet).astype(np.float64)) @ stiffness
+            stiffness.eliminate_zeros()
+        return stiffness.tocsc()
+
+    def expand_solution(self, sol, useDir=False, values=None):
+        # Values at all vertices (or data) from the constrained unknowns.
+        # For the data, values holds the Dirichlet values at all nodes as in
+        # lift_dirichlet, which add to the hanging vertices on edges with
+        # Dirichlet ends.
+        if self.constraints is None:
+            return sol
+        expanded = self.constraints[useDir] @ sol
+        if values is not None and not useDir:
+            expanded += self.constrained_dirichlet_values(values)[~self.is_dirichlet_node]
+        return expanded
+
+    def constrained_dirichlet_values(self, values):
+        # The Dirichlet values g at the Dirichlet nodes and, at the hanging
+        # vertices, the part of the constraint 0.5 * (g_a + g_b) from the
+        # ends of their edge that are Dirichlet nodes. Zero elsewhere.
+        values = np.where(self.is_dirichlet_node, values, 0.0)
+        if self.constraints is not None:
+            values[self.hanging_vertices] = 0.5 * values[self.hanging_ends].sum(axis=1)
+        return values
+
+    def reference_stiffness(self):
+        # Integrand of the stiffness matrix of the reference cell, for each
+        # pair of basis functions and quadrature point, and the weight of
+        # each quadrature point.
+        gradients = self.tabulation.gradients
+        integrand = np.einsum("qad,qbd->abdq", gradients, gradients)
+        return integrand[..., 0, :] + integrand[..., 1, :], self.area_reference_cell * self.tabulation.weights
 
+    def assemble_stiffness(self):
+        # Stiffness matrix of all nodes, Dirichlet nodes included (CSR)
+        gradients, weights = self.reference_stiffness()
+        rows, cols, values = element_terms(self.cell_nodes, self.coefficient(self.k_at), gradients, weights)
+        return assemble(rows, cols, values, (self.number_of_vertices, self.number_of_vertices))
+
+    def setup_stiffness_parallel(self, useDir=False, workers=None, chunk_size=16384, threads=False):
+        """setup_stiffness assembled by a pool of workers (processes, or
+        threads with threads=True) over chunks of chunk_size cells.
+
+        Each chunk sums its own terms into partial triplets in shared memory,
+        which are then summed in the order of the chunks. The chunks do not
+        depend on the number of workers, so neither does the result. It
+        agrees with setup_stiffness up to rounding.
+        """
+        gradients, weights = self.reference_stiffness()
+        n = self.number_of_vertices if useDir else self.number_of_data
+        number_of_cells = len(self.cell_nodes)
+        terms_per_cell = self.cell_nodes.shape[1]**2 * (len(weights) if self.degree == 1 else 1)
+        starts = np.arange(0, number_of_cells, chunk_size)
+
+        memories = []
+        try:
+            inputs = []
+            for array in (np.ascontiguousarray(self.cell_nodes), np.ascontiguousarray(self.coefficient(self.k_at)),
+                          np.ascontiguousarray(self.node_idx_to_data_idx[:self.number_of_vertices])):
+                memory, description = share(array)
+                memories.append(memory)
+                inputs.append(description)
+            outputs = []
+            for dtype in (np.int64, np.float64):
+                memory, description = share(np.zeros(number_of_cells * terms_per_cell, dtype=dtype))
+                memories.append(memory)
+                outputs.append(description)
+            tasks = [(inputs, outputs, start, min(start + chunk_size, number_of_cells), start * terms_per_cell,
+                      gradients, weights, n, useDir) for start in starts]
+            Executor = futures.ThreadPoolExecutor if threads else futures.ProcessPoolExecutor
+            with Executor(max_workers=workers) as executor:
+                counts = list(executor.map(assemble_chunk, tasks))
+
+            keys = np.ndarray((number_of_cells * terms_per_cell,), dtype=np.int64, buffer=memories[3].buf)
+            sums = np.ndarray((number_of_cells * terms_per_cell,), dtype=np.float64, buffer=memories[4].buf)
+            chunks = [slice(start * terms_per_cell, start * terms_per_cell + count) for start, count in zip(starts, counts)]
+            keys, sums = sum_duplicates(np.concatenate([keys[chunk] for chunk in chunks]),
+                                        np.concatenate([sums[chunk] for chunk in chunks]))
+        finally:
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+        nonzero = sums != 0
+        keys = keys[nonzero]
+        stiffness = sp.csr_matrix((sums[nonzero], (keys // n, keys % n)), shape=(n, n))
+        if self.constraints is not None:
+            return self.apply_constraints(stiffness, useDir)
         return stiffness.tocsc()
 
-    def setup_rhs(self, useDir=False):
+    def eliminate_dirichlet(self, stiffness, useDir=False):
+        """Zero the Dirichlet rows of the CSR stiffness matrix of all nodes
+        (useDir), or keep the rows and columns of the data only."""
         if useDir:
-            rhs = np.zeros(self.number_of_vertices)
+            stiffness = stiffness.copy()
+            rows = np.repeat(np.arange(stiffness.shape[0]), np.diff(stiffness.indptr))
+            stiffness.data[self.is_dirichlet_node[rows]] = 0.0
+            stiffness.eliminate_zeros()
+            return stiffness
+        data_idx_to_node_idx = np.flatnonzero(~self.is_dirichlet_node)
+        return stiffness[data_idx_to_node_idx][:, data_idx_to_node_idx]
+
+    def setup_stiffness(self, useDir=False):
+        stiffness = self.eliminate_dirichlet(self.assemble_stiffness(), useDir)
+        if self.constraints is not None:
+            return self.apply_constraints(stiffness, useDir)
+        return stiffness.tocsc()
+
+    def stiffness_pattern(self, useDir=False):
+        """Sparsity pattern of setup_stiffness(useDir) in CSC format, with
+        every entry any cell contributes to, and the terms of assembly that
+        are kept and their position in the data of the pattern. These are
+        computed once per useDir."""
+        if useDir not in self.patterns:
+            vertices = self.cell_nodes
+            rows = np.repeat(vertices, vertices.shape[1], axis=1).ravel()
+            cols = np.tile(vertices, vertices.shape[1]).ravel()
+            if useDir:
+                # Dirichlet rows are zero
+                keep = ~self.is_dirichlet_node[rows]
+                n = self.number_of_vertices
+            else:
+                keep = ~self.is_dirichlet_node[rows] & ~self.is_dirichlet_node[cols]
+                rows = self.node_idx_to_data_idx[rows]
+                cols = self.node_idx_to_data_idx[cols]
+                n = self.number_of_data
+            keys = cols[keep].astype(np.int64) * n + rows[keep]
+            keys, position = np.unique(keys, return_inverse=True)
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // n, minlength=n))])
+            pattern = sp.csc_matrix((np.zeros(len(keys)), keys % n, indptr), shape=(n, n))
+            # One position for each term of element_values of a kept pair
+            if self.degree == 1:
+                position = np.repeat(position.ravel(), len(self.tabulation.weights))
+            self.patterns[useDir] = (pattern, keep, position)
+        return self.patterns[useDir]
+
+    def refill_stiffness(self, useDir=False, out=None, k=None):
+        """setup_stiffness(useDir) in the fixed pattern of stiffness_pattern.
+
+        The values of out, a matrix returned by an earlier call, are
+        overwritten in place, no new matrix is built. k gives the
+        coefficient per cell (cells,) or per cell and quadrature point,
+        by default the cached coefficient of eval_k is used. Entries that
+        sum to zero stay in the pattern as explicit zeros.
+
+        With leaf cells the matrix of all vertices is refilled in its
+        pattern and apply_constraints builds a new constrained matrix, so
+        out cannot be given.
+        """
+        if self.constraints is not None and out is not None:
+            raise ValueError("out is not supported for the constrained matrices of leaf cells")
+        pattern, keep, position = self.stiffness_pattern(useDir)
+        if k is None:
+            K = self.coefficient(self.k_at)
+        else:
+            K = np.asarray(k, dtype=np.float64).reshape(len(self.cell_nodes), -1)
+        gradients, weights = self.reference_stiffness()
+        values = element_values(K, gradients, weights)
+        values = values.reshape(-1, values.shape[-1])[keep]
+        if out is None:
+            out = pattern.copy()
+        out.data[:] = np.bincount(position, weights=values.ravel(), minlength=out.nnz)
+        if self.constraints is not None:
+            return self.apply_constraints(out, useDir)
+        return out
+
+    def lift_dirichlet(self, values, stiffness=None):
+        """Right hand side contribution -A g of the values g at the Dirichlet
+        nodes, for the data. values holds g at all nodes, stiffness is the
+        matrix from assemble_stiffness (assembled if not given)."""
+        if stiffness is None:
+            stiffness = self.assemble_stiffness()
+        lifted = -(stiffness @ self.constrained_dirichlet_values(values))[~self.is_dirichlet_node]
+        if self.constraints is not None:
+            return self.constraints[False].T @ lifted
+        return lifted
+
+    def stiffness_operator(self, useDir=False):
+        # The stiffness matrix of setup_stiffness as a matrix-free operator
+        return StiffnessOperator(self, useDir)
+
+    def setup_rhs(self, useDir=False, f=None, t=0.0):
+        """Load vector of the source f(x, y, t), which is called once with
+        arrays of the coordinates of all quadrature points. Without f the
+        source is 1. With useDir, the vector holds the Dirichlet values.
+        """
+        grid = self.geometry.grid
+        vertices = self.cell_nodes
+        if useDir:
+            # Dirichlet vertices not contained in rhs
+            rhs = self.dirichlet_values()
         else:
-            rhs = np.zeros(self.number_of_data)
-        for cell in self.geometry.grid.dfs(self.level):
-            for lin, vertex in enumerate(cell.vertices):
-                if vertex in self.cur_dirichlet_vertices:
-                    if useDir:
-                        # Dirichlet vertices not contained in rhs
-                        if cell.center[0]<cell.size:
-                            rhs[vertex] = 1.0
-                        else:
-                            rhs[vertex] = 0.0
-                    continue
-                data_idx = self.geometry.vertex_idx_to_data_idx[vertex]
-                for lin_quad in range(4):
-                    quad_i, quad_j = lin2cart(lin_quad)
-                    x, y = self.quad_x[quad_i], self.quad_x[quad_j]
-                    quad_coords = np.array([x, y])
-                    quad_weight = self.quad_w[quad_i] * self.quad_w[quad_j]
-                    factor = area(cell) * quad_weight
-                    if useDir:
-                        rhs[vertex] +=0.0
-                    else:
-                        rhs[data_idx] +=  factor * lagrange_2d(self.nodes_x, lin, quad_coords)
+            sizes = grid.level_sizes(self.level)
+            weights = (sizes * sizes)[:, None] * self.tabulation.weights
+            if f is not None:
+                points = self.quadrature_points()
+                weights = weights * f(points[..., 0], points[..., 1], t)
+            # Contribution of each cell, basis function and quadrature point
+            values = weights[:, None, :] * self.tabulation.values.T
+            data = self.node_idx_to_data_idx[vertices]
+            keep = data >= 0
+            rhs = np.bincount(np.repeat(data[keep], values.shape[-1]), weights=values[keep].ravel(),
+                              minlength=self.number_of_data)
+        if self.constraints is not None:
+            return self.constraints[useDir].T @ rhs
         return rhs
 
     def setup_initial(self):
-        u0 = np.zeros(self.number_of_vertices)
-        for cell in self.geometry.grid.dfs(self.level):
-            for lin, vertex in enumerate(cell.vertices):
-                if vertex in self.cur_dirichlet_vertices and cell.center[0]<cell.size:
-                    # Dirichlet vertices not contained in rhs
-                    u0[vertex] = 1.0
-                    continue
-                u0[vertex] = 0.0
+        u0 = self.dirichlet_values()
+        if self.constraints is not None:
+            return u0[self.free_vertices]
         return u0
 
+    def dirichlet_values(self, g=None):
+        """Values at all nodes, zero except at the Dirichlet nodes, where they
+        are g(x, y) (called once with arrays of the coordinates). Without
+        g, Dirichlet nodes are 1 if the last cell that contains them is in
+        the first column of cells.
+        """
+        if g is not None:
+            coords = self.node_coordinates()[self.is_dirichlet_node]
+            values = np.zeros(self.number_of_vertices)
+            values[self.is_dirichlet_node] = g(coords[:, 0], coords[:, 1])
+            return values
+        grid = self.geometry.grid
+        vertices = self.cell_nodes
+        in_first_column = grid.level_centers(self.level)[:, 0] < grid.level_sizes(self.level)
+        last_cell = np.full(self.number_of_vertices, -1)
+        np.maximum.at(last_cell, vertices.ravel(), np.repeat(np.arange(len(vertices)), vertices.shape[1]))
+        return (self.is_dirichlet_node & (last_cell >= 0) & in_first_column[last_cell]).astype(np.float64)
+
+    def node_coordinates(self):
+        # Coordinates of the nodes. Those of degree 1 are taken from the
+        # corners of the cells, so the geometry needs no vertex_coords.
+        if self.node_coords is None:
+            grid = self.geometry.grid
+            corner_i, corner_j = lin2cart(np.arange(4))
+            corners = np.stack([2 * corner_i - 1, 2 * corner_j - 1], axis=-1)
+            coords = grid.level_centers(self.level)[:, None, :] + \
+                0.5 * grid.level_sizes(self.level)[:, None, None] * corners
+            self.node_coords = np.zeros((self.number_of_vertices, 2))
+            self.node_coords[self.cell_nodes.ravel()] = coords.reshape(-1, 2)
+        return self.node_coords
+
+    def quadrature_points(self):
+        # Global coordinates of the quadrature points of the cells of the
+        # level, shape (cells, quadrature points, 2).
+        grid = self.geometry.grid
+        centers = grid.level_centers(self.level)
+        sizes = grid.level_sizes(self.level)
+        return centers[:, None, :] + 0.5 * sizes[:, None, None] * self.tabulation.points
+
+
+class StiffnessOperator(splinalg.LinearOperator):
+    """Action of the stiffness matrix of a discretization without assembling
+    it, the same operator as Discretization.setup_stiffness(useDir).
+
+    Each product gathers the values at the corners of all cells, applies
+    the element matrices and adds the result back to the vertices. Only the
+    reference element matrix, the coefficient of each cell and the
+    connectivity are stored.
+    """
+    def __init__(self, discretization, useDir=False):
+        d = discretization
+        vertices = d.cell_nodes
+        data = d.node_idx_to_data_idx[vertices]
+        gradients, weights = d.reference_stiffness()
+        K = d.coefficient(d.k_at)
+        self.sum_factorised = d.degree > 1
+        if self.sum_factorised:
+            # The gradients at the quadrature points follow from 1d matrices
+            # applied along each axis, O(p^3) instead of O(p^4) per cell.
+            self.values_1d = d.tabulation.values_1d
+            self.derivatives_1d = d.tabulation.derivatives_1d
+            self.weights = weights
+            self.factor = K
+            self.reference = np.zeros((0, 0))
+        elif K.shape[1] == 1:
+            # The element matrix is the reference one scaled by k
+            gradients = (gradients * weights).sum(axis=-1)[..., None]
+            self.factor = K
+        else:
+            self.factor = weights[None, :] * K
+        if not self.sum_factorised:
+            # Entry (b, a * n + q) is entry (a, b) of the element matrix of
+            # quadrature point q (of n), so the corner values of all cells
+            # are multiplied with all element matrices in one product.
+            self.reference = gradients.transpose(1, 0, 2).reshape(len(gradients), -1)
+
+        n = d.number_of_vertices if useDir else d.number_of_data
+        # Dirichlet rows are zero, which the scatter drops into entry n. The
+        # Dirichlet data are zero, which the gather reads from entry n.
+        self.rows = np.where(data >= 0, vertices if useDir else data, n)
+        self.cols = vertices if useDir else self.rows
+        self.size = n
+
+        self.constraints = d.constraints[useDir] if d.constraints is not None else None
+        if self.constraints is not None:
+            self.dirichlet_rows = d.geometry.vertex_idx_to_data_idx[d.free_vertices] < 0 if useDir else None
+            n = self.constraints.shape[1]
+        super().__init__(dtype=np.float64, shape=(n, n))
+
+    @property
+    def nbytes(self):
+        arrays = {id(a): a for a in (self.reference, self.factor, self.rows, self.cols)}
+        return sum(a.nbytes for a in arrays.values())
+
+    def apply(self, x):
+        # Product with the unconstrained matrix
+        x = np.append(x, 0.0)
+        values = x[self.cols]
+        if self.sum_factorised:
+            y = self.apply_sum_factorised(values)
+        else:
+            y = (values @ self.reference).reshape(len(self.cols), -1, self.factor.shape[1])
+            if self.factor.shape[1] == 1:
+                y = y[..., 0] * self.factor
+            else:
+                y = np.einsum("caq,cq->ca", y, self.factor)
+        return np.bincount(self.rows.ravel(), weights=y.ravel(), minlength=self.size + 1)[:-1]
+
+    def apply_sum_factorised(self, values):
+        # Element matrices times the (cells, nodes) values, with the nodes
+        # and quadrature points of a cell as (x, y) arrays.
+        B, D = self.values_1d, self.derivatives_1d
+        number_of_quad_points, number_of_nodes = B.shape
+        u = values.reshape(-1, number_of_nodes, number_of_nodes)
+        w = (self.factor * self.weights).reshape(-1, number_of_quad_points, number_of_quad_points)
+        u_x = w * (D @ u @ B.T)
+        u_y = w * (B @ u @ D.T)
+        return (D.T @ u_x @ B + B.T @ u_y @ D).reshape(len(values), -1)
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        if self.constraints is None:
+            return self.apply(x)
+        y = self.constraints.T @ self.apply(self.constraints @ x)
+        if self.dirichlet_rows is not None:
+            y[self.dirichlet_rows] = 0.0
+        return y
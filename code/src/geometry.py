@@ -1,3 +1,9 @@
+import hashlib
+import os
+import struct
+import tempfile
+import zipfile
+
 import numpy as np
 import scipy.special as special
 import scipy.sparse as sp
@@ -6,27 +12,36 @@ import scipy.sparse.linalg as splinalg
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import matplotlib.cm as cm
-from matplotlib import patches
+from matplotlib.collections import PolyCollection
 
 import quadtree
-import fem
 
 # Here we build up the geometry.
 # The code is included in the notebook because it makes it easier to see
 # how the vertices get numbered.
 class Geometry:
-    def __init__(self, level, is_dirichlet):
+    def __init__(self, level, is_dirichlet, compact=False, lazy=False):
         center = np.array([0.5, 0.5])
         size = 1.0
-        self.grid = quadtree.Quadtree(center=center, size=size)
+        if lazy:
+            self.init_lazy(level, is_dirichlet, center, size)
+            return
+        if compact:
+            self.grid = quadtree.CompactQuadtree(center=center, size=size)
+        else:
+            self.grid = quadtree.Quadtree(center=center, size=size)
         self.grid.split_to_level(level)
+        self.is_dirichlet = is_dirichlet
 
         self.vertices_coords_to_idx, \
         self.number_of_vertices_per_level, \
         self.boundary_vertices = self.grid.get_vertices()
         self.vertices_idx_to_coords = {v: k for k, v in self.vertices_coords_to_idx.items()}
+        self.vertex_coords = np.array(
+            [self.vertices_idx_to_coords[i] for i in range(len(self.vertices_idx_to_coords))])
         self.grid.set_all_cell_vertices(self.vertices_coords_to_idx)
         self.grid.set_all_cell_indices()
+        self.clear_vertex_lookup()
 
         self.dirichlet_vertices = set()
         for v in self.boundary_vertices:
@@ -34,85 +49,295 @@ class Geometry:
             if is_dirichlet(self.vertices_idx_to_coords[v]):
                 self.dirichlet_vertices.add(v)
 
-        dirichlet_vertices_array = np.array([*self.dirichlet_vertices])
         # We do not store the data for Dirichlet values
+        is_dirichlet_vertex = np.zeros(self.number_of_vertices_per_level[-1], dtype=bool)
+        is_dirichlet_vertex[list(self.dirichlet_vertices)] = True
+        number_of_data = np.cumsum(~is_dirichlet_vertex)
+
+        self.data_size_per_level = [
+            number_of_data[n_vert - 1] for n_vert in self.number_of_vertices_per_level]
+
+        self.vertex_idx_to_data_idx = np.where(
+            is_dirichlet_vertex, -1, number_of_data - 1).astype(np.int32)
+        self.data_idx_to_vertex_idx = np.flatnonzero(~is_dirichlet_vertex).astype(np.int32)
+
+    @property
+    def is_dirichlet_vertex(self):
+        # Mask of the Dirichlet vertices, which have no data
+        return self.vertex_idx_to_data_idx < 0
+
+    def save(self, path):
+        """Store the geometry in an uncompressed .npz file.
+
+        Only uniformly refined grids can be stored, they are loaded as a
+        CompactQuadtree.
+        """
+        grid = self.grid
+        if not isinstance(grid, quadtree.CompactQuadtree):
+            grid = grid.to_compact()
+        is_dirichlet_vertex = self.is_dirichlet_vertex
+        is_boundary_vertex = np.zeros(len(self.vertex_coords), dtype=bool)
+        is_boundary_vertex[list(self.boundary_vertices)] = True
+        np.savez(path,
+                 center=grid.center,
+                 size=np.array([grid.size]),
+                 number_of_vertices_per_level=np.asarray(self.number_of_vertices_per_level),
+                 data_size_per_level=np.asarray(self.data_size_per_level),
+                 vertex_idx_to_data_idx=self.vertex_idx_to_data_idx,
+                 data_idx_to_vertex_idx=self.data_idx_to_vertex_idx,
+                 is_dirichlet_vertex=is_dirichlet_vertex,
+                 is_boundary_vertex=is_boundary_vertex,
+                 **{"grid_" + name: getattr(grid, name) for name in grid.arrays})
+
+    @classmethod
+    def load(cls, path, is_dirichlet=None, mmap=True):
+        """Load a geometry stored with save(). With mmap, the arrays are
+        mapped from the file (copy on write) instead of read.
+
+        As in a lazy geometry, the coordinates of the vertices are kept in
+        the array vertex_coords only, there is no dict from coordinates to
+        vertex index (see vertex_index).
+        """
+        arrays = load_arrays(path, mmap=mmap)
+        geometry = cls.__new__(cls)
+        geometry.grid = quadtree.CompactQuadtree(center=np.array(arrays["center"]), size=arrays["size"][0])
+        for name in geometry.grid.arrays:
+            setattr(geometry.grid, name, arrays["grid_" + name])
+        geometry.is_dirichlet = is_dirichlet
+
+        geometry.vertex_coords = geometry.grid.vertex_coords
+        geometry.vertices_idx_to_coords = geometry.vertex_coords
+        geometry.vertices_coords_to_idx = None
+        geometry.number_of_vertices_per_level = arrays["number_of_vertices_per_level"]
+        geometry.data_size_per_level = list(arrays["data_size_per_level"])
+        geometry.boundary_vertices = set(np.flatnonzero(arrays["is_boundary_vertex"]).tolist())
+        geometry.dirichlet_vertices = set(np.flatnonzero(arrays["is_dirichlet_vertex"]).tolist())
+        geometry.vertex_idx_to_data_idx = arrays["vertex_idx_to_data_idx"]
+        geometry.data_idx_to_vertex_idx = arrays["data_idx_to_vertex_idx"]
+        geometry.clear_vertex_lookup()
+        return geometry
+
+    @classmethod
+    def cached(cls, level, is_dirichlet, cache_dir="geometry-cache", mmap=True):
+        """Load the geometry from cache_dir, or build and store it there.
+
+        The cache is keyed by the level and by the values of is_dirichlet on
+        the boundary vertices of the level, which are all that is used of it.
+        """
+        n = 2**level
+        lattice = np.concatenate([
+            np.stack([np.zeros(n + 1, dtype=np.int64), np.arange(n + 1)], axis=-1),
+            np.stack([np.full(n + 1, n), np.arange(n + 1)], axis=-1),
+            np.stack([np.arange(1, n), np.zeros(n - 1, dtype=np.int64)], axis=-1),
+            np.stack([np.arange(1, n), np.full(n - 1, n)], axis=-1)])
+        coords = lattice / n
+        values = np.array([bool(is_dirichlet(tuple(coord))) for coord in coords.tolist()])
+        key = hashlib.sha1(values.tobytes()).hexdigest()[:16]
+
+        path = os.path.join(cache_dir, "geometry-{}-{}.npz".format(level, key))
+        if os.path.exists(path):
+            return cls.load(path, is_dirichlet=is_dirichlet, mmap=mmap)
+        geometry = cls(level, is_dirichlet, compact=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Several processes may build the same geometry at once. Each writes
+        # its own file and moves it into place, so readers never see a
+        # partially written one.
+        fd, temporary = tempfile.mkstemp(suffix=".npz", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                geometry.save(f)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        return geometry
+
+    def init_lazy(self, level, is_dirichlet, center, size):
+        """Set up a geometry whose levels are built on first use.
+
+        Accessing number_of_vertices_per_level[l] or data_size_per_level[l]
+        splits the grid to level l and numbers its vertices, together with
+        those of all coarser levels. The coordinates of the vertices are
+        kept in the array vertex_coords only, there is no dict from
+        coordinates to vertex index (see vertex_index).
+        """
+        self.grid = quadtree.CompactQuadtree(center=center, size=size)
+        self.is_dirichlet = is_dirichlet
+        self.vertices_coords_to_idx = None
+        self.vertex_coords = self.grid.vertex_coords
+        self.vertices_idx_to_coords = self.vertex_coords
+        self.boundary_vertices = set()
+        self.dirichlet_vertices = set()
+        self.vertex_idx_to_data_idx = np.zeros(0, dtype=np.int32)
+        self.data_idx_to_vertex_idx = np.zeros(0, dtype=np.int32)
+        self.number_of_vertices_per_level = LazyLevels(level + 1, self.build_level)
+        self.data_size_per_level = LazyLevels(level + 1, self.build_level)
+        self.clear_vertex_lookup()
+
+    def build_level(self, level):
+        # Build the levels up to level of a lazy geometry.
+        for level in range(len(self.number_of_vertices_per_level.values), level + 1):
+            number_of_vertices = len(self.vertex_coords)
+            self.grid.number_vertices_to_level(level)
+            self.vertex_coords = self.grid.vertex_coords
+            self.vertices_idx_to_coords = self.vertex_coords
+            lattice = self.grid.vertex_lattice[number_of_vertices:]
+            on_boundary = np.any((lattice == 0) | (lattice == 2**quadtree.LATTICE_LEVEL), axis=1)
+            self.add_vertices(number_of_vertices, number_of_vertices + np.flatnonzero(on_boundary))
+            self.number_of_vertices_per_level.values.append(len(self.vertex_coords))
+            self.data_size_per_level.values.append(len(self.data_idx_to_vertex_idx))
+
+    def clear_vertex_lookup(self):
+        # Lattice keys of the vertices sorted for vertex_index, and their
+        # indices. They are extended by the vertices added since the last
+        # lookup.
+        self.sorted_vertex_keys = np.zeros(0, dtype=np.int64)
+        self.sorted_vertex_indices = np.zeros(0, dtype=np.int64)
+
+    def vertex_keys(self, coords):
+        scale = 2**quadtree.LATTICE_LEVEL / self.grid.size
+        return quadtree.lattice_keys(np.rint((np.asarray(coords) - self.grid.offset) * scale).astype(np.int64))
 
-        self.data_size_per_level = []
-        for level in range(self.grid.get_max_level()+1):
-            n_vert = self.number_of_vertices_per_level[level]
-            n_dirichlet_vert = len(
-                dirichlet_vertices_array[
-                    dirichlet_vertices_array < n_vert])
-            self.data_size_per_level.append(n_vert - n_dirichlet_vert)
-
-        self.vertex_idx_to_data_idx = np.zeros(self.number_of_vertices_per_level[-1], dtype=np.int32)
-        self.data_idx_to_vertex_idx = np.zeros(self.data_size_per_level[-1], dtype=np.int32)
-        cur_data_idx = 0
-        for i in range(self.number_of_vertices_per_level[-1]):
-            if i in self.dirichlet_vertices:
-                self.vertex_idx_to_data_idx[i] = -1
+    def vertex_index(self, coords):
+        """Index of the vertices at the given (n, 2) coordinates, -1 where
+        there is no vertex."""
+        number_of_known = len(self.sorted_vertex_keys)
+        if number_of_known < len(self.vertex_coords):
+            self.sorted_vertex_keys, self.sorted_vertex_indices = quadtree.insert_sorted_keys(
+                self.sorted_vertex_keys, self.sorted_vertex_indices,
+                self.vertex_keys(self.vertex_coords[number_of_known:]), number_of_known)
+        if len(self.sorted_vertex_keys) == 0:
+            return np.full(len(coords), -1)
+        keys = self.vertex_keys(coords)
+        position = np.minimum(np.searchsorted(self.sorted_vertex_keys, keys), len(self.sorted_vertex_keys) - 1)
+        return np.where(self.sorted_vertex_keys[position] == keys, self.sorted_vertex_indices[position], -1)
+
+    def add_vertices(self, number_of_vertices, boundary_vertices):
+        # Dirichlet vertices and data indices of the vertices from
+        # number_of_vertices on, which are already in vertex_coords.
+        self.boundary_vertices.update(boundary_vertices)
+        is_dirichlet_vertex = np.zeros(len(self.vertex_coords) - number_of_vertices, dtype=bool)
+        for v in boundary_vertices:
+            if self.is_dirichlet(tuple(self.vertex_coords[v])):
+                self.dirichlet_vertices.add(v)
+                is_dirichlet_vertex[v - number_of_vertices] = True
+
+        number_of_data = len(self.data_idx_to_vertex_idx)
+        self.vertex_idx_to_data_idx = np.concatenate([
+            self.vertex_idx_to_data_idx,
+            np.where(is_dirichlet_vertex, -1, number_of_data + np.cumsum(~is_dirichlet_vertex) - 1).astype(np.int32)])
+        self.data_idx_to_vertex_idx = np.concatenate([
+            self.data_idx_to_vertex_idx,
+            (number_of_vertices + np.flatnonzero(~is_dirichlet_vertex)).astype(np.int32)])
+
+    def refine(self, cells):
+        """Refine the given leaf cells of the grid (see Quadtree.refine).
+
+        New vertices are numbered after the existing ones, which keep their
+        vertex and data index. The per-level counts remain those of the
+        uniform levels, the refined grid is used through its leaves
+        (fem.Discretization with level=None). Returns the new cells.
+
+        Only the object Quadtree can be refined, not the CompactQuadtree of
+        compact or lazy geometries.
+        """
+        if not isinstance(self.grid, quadtree.Quadtree):
+            raise ValueError("refinement needs a geometry with the object Quadtree, not compact or lazy")
+        number_of_vertices = len(self.vertex_coords)
+        new_cells = self.grid.refine(cells)
+        new_keys = self.grid.vertex_keys[number_of_vertices:]
+        vertices, boundary_vertices = quadtree.vertex_maps(
+            new_keys, self.grid.offset, self.grid.size, start=number_of_vertices)
+
+        self.vertices_coords_to_idx.update(vertices)
+        self.vertices_idx_to_coords.update({v: k for k, v in vertices.items()})
+        self.vertex_coords = np.concatenate([self.vertex_coords, np.array(list(vertices.keys())).reshape(-1, 2)])
+        self.add_vertices(number_of_vertices, boundary_vertices)
+        return new_cells
+
+
+class LazyLevels:
+    # Per-level values of a lazy Geometry, a level is built when its value
+    # is first read.
+    def __init__(self, number_of_levels, build):
+        self.number_of_levels = number_of_levels
+        self.build = build
+        self.values = []
+
+    def __len__(self):
+        return self.number_of_levels
+
+    def __getitem__(self, level):
+        if isinstance(level, slice):
+            return [self[l] for l in range(*level.indices(len(self)))]
+        if level < 0:
+            level += len(self)
+        if not 0 <= level < len(self):
+            raise IndexError("level out of range")
+        if level >= len(self.values):
+            self.build(level)
+        return self.values[level]
+
+
+def load_arrays(path, mmap=False):
+    # Arrays of an .npz file written by np.savez. These are stored
+    # uncompressed, so each can be memory mapped from its offset in the file.
+    if not mmap:
+        with np.load(path) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+    arrays = dict()
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            # Skip the local file header, 30 bytes plus name and extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
             else:
-                self.vertex_idx_to_data_idx[i] = cur_data_idx
-                self.data_idx_to_vertex_idx[cur_data_idx] = i
-                cur_data_idx += 1       
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len(".npy")]
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="c", offset=f.tell(), shape=shape,
+                                         order="F" if fortran_order else "C")
+    return arrays
 
 def plot_solution(geometry, discretization, dirichlet_val, sol,level):   # First find minimum and maximum material parameter
-    min_k, max_k = float('inf'), float('-inf')
-    for cell in geometry.grid.dfs(only_level=level):
-        k = discretization.eval_k(cell.center[0], cell.center[1])
-        min_k = min(k, min_k)
-        max_k = max(k, max_k)
+    centers = geometry.grid.level_centers(level)
+    sizes = geometry.grid.level_sizes(level)
+    cell_vertices = geometry.grid.level_vertices(level)
+    k = discretization.coefficient()[:, 0]
 
     # Set up color scales for the solution and the material k.
     norm_solution = mpl.colors.Normalize(vmin=min(0.0,sol.min()), vmax=max(1.0,sol.max()))
-    norm_k = mpl.colors.Normalize(vmin=min_k, vmax=max_k)
+    norm_k = mpl.colors.Normalize(vmin=k.min(), vmax=k.max())
     cmap = cm.viridis
     color_mapper_solution = cm.ScalarMappable(norm=norm_solution, cmap=cmap)
     color_mapper_k = cm.ScalarMappable(norm=norm_k, cmap=cmap)
 
     fig, axs = plt.subplots(1,2, figsize=(18,8))
 
-    # Lists to store Dirichlet vertices.
-    dirichlet_xs = []
-    dirichlet_ys = []
-
-    for cell in geometry.grid.dfs(only_level=level):
-        value = 0.0
-        # Evaluate all basis functions at (0.5, 0.5)
-        for i, vertex in enumerate(cell.vertices):
-            # Ignore dirichlet boundary conditions.
-            # Their value is not stored and is always zero.
-            if vertex not in geometry.dirichlet_vertices:
-                # Here we get the index of the data correspond to the vertex.
-                #data_idx = geometry.vertex_idx_to_data_idx[vertex]
-                value += sol[vertex] * fem.lagrange_2d(discretization.nodes_x, i, (0.5,0.5))
-            else:
-                value += dirichlet_val(cell.center,cell.size, cell.size) * fem.lagrange_2d(discretization.nodes_x, i, (0.5,0.5))
-
-        # Plot the rectangles that build up the grid.
-        rect = patches.Rectangle(
-            cell.offset,
-            cell.size,
-            cell.size,
-            fill=True,
-            color=color_mapper_solution.to_rgba(value))
-        axs[0].add_patch(rect)
-
-        # Plot material
-        value = discretization.eval_k(cell.center[0], cell.center[1])
-        rect = patches.Rectangle(
-            cell.offset,
-            cell.size,
-            cell.size,
-            fill=True,
-            color=color_mapper_k.to_rgba(value))
-        axs[1].add_patch(rect)    
-
-        # Find dirichlet vertices
-        for v in cell.vertices:
-            if v in geometry.dirichlet_vertices:
-                dirichlet_xs.append(geometry.vertices_idx_to_coords[v][0])
-                dirichlet_ys.append(geometry.vertices_idx_to_coords[v][1])
+    # Evaluate all basis functions at (0.5, 0.5)
+    basis = discretization.tabulation.at([0.5, 0.5])[0]
+    is_dirichlet_vertex = geometry.vertex_idx_to_data_idx[cell_vertices] < 0
+    values = sol[cell_vertices]
+    # Dirichlet values are not stored in the solution.
+    for cell in np.flatnonzero(is_dirichlet_vertex.any(axis=1)):
+        values[cell, is_dirichlet_vertex[cell]] = dirichlet_val(centers[cell], sizes[cell], sizes[cell])
+    value = values @ basis
+
+    # Plot the rectangles that build up the grid.
+    offsets = centers - 0.5 * sizes[:, None]
+    corners = offsets[:, None, :] + sizes[:, None, None] * np.array([[0, 0], [1, 0], [1, 1], [0, 1]])
+    for ax, colors in ((axs[0], color_mapper_solution.to_rgba(value)),
+                       (axs[1], color_mapper_k.to_rgba(k))):
+        ax.add_collection(PolyCollection(corners, facecolors=colors, edgecolors=colors))
+
+    # Find dirichlet vertices
+    dirichlet_xs, dirichlet_ys = geometry.vertex_coords[cell_vertices[is_dirichlet_vertex]].T
 
     axs[0].set_title("Solution")
     axs[0].axis('square')
@@ -0,0 +1,394 @@
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as splinalg
+
+import fem
+
+# Weight of the coarse node I (0 or 1) of a 1d coarse cell at the fine
+# position t (0, 1 or 2, in units of the fine size) for linear elements.
+LINEAR_WEIGHTS = np.array([[1.0, 0.0], [0.5, 0.5], [0.0, 1.0]])
+
+
+def make_interpolation(geometry, level_coarse):
+    """Bilinear interpolation from the data of level_coarse to the data of
+    the next level, in CSR format.
+
+    A corner of a fine cell lies at position (dx + i, dy + j) of its parent,
+    where (dx, dy) is the position of the child and (i, j) that of the
+    corner, so its weights are products of LINEAR_WEIGHTS: 1 at coarse
+    vertices, 1/2 at edge midpoints and 1/4 at cell centers.
+    """
+    level_fine = level_coarse + 1
+    # Reading the sizes first builds the levels of a lazy geometry.
+    n = np.int64(geometry.data_size_per_level[level_coarse])
+    n_fine = geometry.data_size_per_level[level_fine]
+    grid = geometry.grid
+    parents = grid.level_parents(level_fine)
+    fine_vertices = grid.level_vertices(level_fine)
+    coarse_vertices = grid.level_vertices(level_coarse)[parents]
+    child = (grid.level_centers(level_fine) > grid.level_centers(level_coarse)[parents]).astype(np.int64)
+
+    corner_i, corner_j = fem.lin2cart(np.arange(4))
+    position_x = child[:, 0, None] + corner_i
+    position_y = child[:, 1, None] + corner_j
+    # weights[cell, fine corner, coarse corner]
+    weights = LINEAR_WEIGHTS[position_x][:, :, corner_i] * LINEAR_WEIGHTS[position_y][:, :, corner_j]
+
+    rows = geometry.vertex_idx_to_data_idx[np.broadcast_to(fine_vertices[:, :, None], weights.shape)]
+    cols = geometry.vertex_idx_to_data_idx[np.broadcast_to(coarse_vertices[:, None, :], weights.shape)]
+    keep = (rows >= 0) & (cols >= 0) & (weights != 0)
+    # A fine vertex gets the same weights from all cells that contain it
+    keys, first = np.unique(rows[keep].astype(np.int64) * n + cols[keep], return_index=True)
+    return sp.csr_matrix((weights[keep][first], (keys // n, keys % n)), shape=(n_fine, n))
+
+
+def make_restriction(geometry, level_coarse):
+    return make_interpolation(geometry, level_coarse).T.tocsr()
+
+
+class Hierarchy:
+    """Operators of the levels level_min..level_max and the prolongations
+    between them, index level - level_min.
+
+    prolongations[i] maps level i - 1 to level i (None for the coarsest).
+    statistics holds the rows, nonzeros and setup time per level, and the
+    grid and operator complexities (sums over all levels relative to the
+    finest level).
+    """
+    def __init__(self, level_min, level_max, operators, prolongations, times, coarsening):
+        self.level_min = level_min
+        self.level_max = level_max
+        self.operators = operators
+        self.prolongations = prolongations
+        self.coarsening = coarsening
+
+        rows = np.array([operator.shape[0] for operator in operators])
+        nnz = np.array([operator.nnz for operator in operators])
+        self.statistics = {
+            "rows": rows,
+            "nnz": nnz,
+            "time": np.array(times),
+            "total_time": float(np.sum(times)),
+            "grid_complexity": rows.sum() / rows[-1],
+            "operator_complexity": nnz.sum() / nnz[-1],
+        }
+
+    def summary(self):
+        lines = ["{} hierarchy, levels {}..{}".format(self.coarsening, self.level_min, self.level_max),
+                 "{:>5} {:>10} {:>10} {:>10}".format("level", "rows", "nnz", "seconds")]
+        statistics = self.statistics
+        for i in range(len(self.operators)):
+            lines.append("{:>5} {:>10} {:>10} {:>10.4f}".format(
+                self.level_min + i, statistics["rows"][i], statistics["nnz"][i], statistics["time"][i]))
+        lines.append("grid complexity {:.3f}, operator complexity {:.3f}, total {:.4f} s".format(
+            statistics["grid_complexity"], statistics["operator_complexity"], statistics["total_time"]))
+        return "\n".join(lines)
+
+
+def build_hierarchy(geometry, level_min, level_max, eval_k, coarsening="galerkin", stiffness=None, **options):
+    """Stiffness matrices (data only, CSR) of all levels in one sweep from
+    the finest level down.
+
+    With coarsening="galerkin" only level_max is discretised, coarser levels
+    are R A P with the bilinear prolongation P and R = P^T. With
+    "rediscretization" every level is assembled with fem.Discretization,
+    which gets the further options. A given stiffness is used as the matrix
+    of level_max instead of discretising it.
+    """
+    if coarsening not in ("galerkin", "rediscretization"):
+        raise ValueError("unknown coarsening {}".format(coarsening))
+    number_of_levels = level_max - level_min + 1
+    operators = [None] * number_of_levels
+    prolongations = [None] * number_of_levels
+    times = [0.0] * number_of_levels
+    for i in range(number_of_levels - 1, -1, -1):
+        level = level_min + i
+        start = time.perf_counter()
+        if i > 0:
+            prolongations[i] = make_interpolation(geometry, level - 1)
+        if level == level_max and stiffness is not None:
+            operators[i] = stiffness.tocsr()
+        elif coarsening == "rediscretization" or level == level_max:
+            discretization = fem.Discretization(geometry, level, eval_k, **options)
+            operators[i] = discretization.setup_stiffness().tocsr()
+        else:
+            P = prolongations[i + 1]
+            operators[i] = (P.T @ operators[i + 1] @ P).tocsr()
+        times[i] = time.perf_counter() - start
+    return Hierarchy(level_min, level_max, operators, prolongations, times, coarsening)
+
+
+def compute_residual(A, x, b):
+    return np.linalg.norm(A @ x - b)
+
+
+class CountedOperator:
+    # A matrix that counts its products with vectors
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.shape = matrix.shape
+        self.count = 0
+
+    def __matmul__(self, x):
+        self.count += 1
+        return self.matrix @ x
+
+
+# The smoothers take the residual b - A x0 if the caller knows it already
+# and return the result together with its residual, which is only computed
+# with return_residual (None otherwise).
+
+def jacobi(A, b, x0, max_iter, inverse_diagonal=None, omega=1.0, residual=None, return_residual=False):
+    # (Damped) Jacobi relaxation, x <- x + omega D^-1 (b - A x)
+    if inverse_diagonal is None:
+        inverse_diagonal = 1.0 / A.diagonal()
+    x = x0
+    for i in range(max_iter):
+        if residual is None:
+            residual = b - A @ x
+        x = x + omega * inverse_diagonal * residual
+        residual = None
+    if return_residual and residual is None:
+        residual = b - A @ x
+    return x, residual
+
+
+def estimate_lambda_max(A, inverse_diagonal, iterations=10):
+    """Largest eigenvalue of D^-1 A from a few Lanczos iterations on the
+    similar symmetric matrix D^-1/2 A D^-1/2."""
+    scaling = np.sqrt(inverse_diagonal)
+    q = np.random.default_rng(0).random(A.shape[0])
+    q /= np.linalg.norm(q)
+    q_previous = np.zeros_like(q)
+    alphas = []
+    betas = []
+    beta = 0.0
+    for i in range(min(iterations, A.shape[0])):
+        w = scaling * (A @ (scaling * q)) - beta * q_previous
+        alpha = q @ w
+        w -= alpha * q
+        alphas.append(alpha)
+        beta = np.linalg.norm(w)
+        if beta < 1e-12 * abs(alpha):
+            break
+        betas.append(beta)
+        q_previous, q = q, w / beta
+    tridiagonal = np.diag(alphas) + np.diag(betas[:len(alphas) - 1], 1) + np.diag(betas[:len(alphas) - 1], -1)
+    return np.linalg.eigvalsh(tridiagonal)[-1]
+
+
+def chebyshev(A, b, x0, max_iter, lambda_max, inverse_diagonal, smoothing_range=30.0,
+              residual=None, return_residual=False):
+    # Chebyshev iteration for D^-1 A x = D^-1 b on the eigenvalues in
+    # [upper / smoothing_range, upper], one product with A per iteration.
+    # The estimate of lambda_max is raised by 10% as Lanczos approaches it
+    # from below.
+    upper = 1.1 * lambda_max
+    lower = upper / smoothing_range
+    theta = (upper + lower) / 2
+    delta = (upper - lower) / 2
+    sigma = theta / delta
+    rho = 1 / sigma
+    x = x0
+    if max_iter == 0:
+        return jacobi(A, b, x, 0, inverse_diagonal, residual=residual, return_residual=return_residual)
+    if residual is None:
+        residual = b - A @ x
+    direction = inverse_diagonal * residual / theta
+    for i in range(max_iter - 1):
+        x = x + direction
+        residual = residual - A @ direction
+        rho_new = 1 / (2 * sigma - rho)
+        direction = rho_new * rho * direction + 2 * rho_new / delta * inverse_diagonal * residual
+        rho = rho_new
+    x = x + direction
+    return x, b - A @ x if return_residual else None
+
+
+class MultigridStorage:
+    """Operators of the levels level_min..level_max for multigrid, index
+    level - level_min.
+
+    stiffness[-1] is the given matrix of level_max (data only), coarser
+    levels are Galerkin products R A P from build_hierarchy, which is kept
+    in hierarchy. coarse_to_fine[i] interpolates from level i - 1 to level
+    i, fine_to_coarse[i] is its transpose. Both are None on level_min. For
+    the implicit Euler method pass I + dt * A as the stiffness.
+
+    The smoother is "jacobi", Jacobi relaxation with damping omega, or
+    "chebyshev", where the number of smoothing steps is the degree of the
+    polynomial. lambda_max[i] caches the estimate of the largest eigenvalue
+    of D^-1 A the Chebyshev smoother needs, computed once per level.
+
+    The cycles multiply with operators[i], which count the products; spmv
+    holds the counts per level and reset_spmv() sets them to zero.
+    """
+    def __init__(self, discretization, level_min, level_max, stiffness, smoother="jacobi", omega=1.0):
+        if smoother not in ("jacobi", "chebyshev"):
+            raise ValueError("unknown smoother {}".format(smoother))
+        self.level_min = level_min
+        self.level_max = level_max
+        self.geometry = discretization.geometry
+
+        number_of_levels = level_max - level_min + 1
+        self.hierarchy = build_hierarchy(self.geometry, level_min, level_max, discretization.eval_k,
+                                         stiffness=stiffness)
+        self.stiffness = self.hierarchy.operators
+        self.coarse_to_fine = self.hierarchy.prolongations
+        self.fine_to_coarse = [None if interpolation is None else interpolation.T.tocsr()
+                               for interpolation in self.coarse_to_fine]
+        self.operators = [CountedOperator(stiffness) for stiffness in self.stiffness]
+        self.inverse_diagonal = [1.0 / stiffness.diagonal() for stiffness in self.stiffness]
+        self.smoother = smoother
+        self.omega = omega
+        self.lambda_max = [None] * number_of_levels
+        if smoother == "chebyshev":
+            self.lambda_max = [estimate_lambda_max(stiffness, inverse_diagonal)
+                               for stiffness, inverse_diagonal in zip(self.stiffness, self.inverse_diagonal)]
+
+    @property
+    def spmv(self):
+        return np.array([operator.count for operator in self.operators])
+
+    def reset_spmv(self):
+        for operator in self.operators:
+            operator.count = 0
+
+    def smooth(self, level, rhs, unknowns, iterations, residual=None, return_residual=False):
+        level_index = level - self.level_min
+        if self.smoother == "chebyshev":
+            return chebyshev(self.operators[level_index], rhs, unknowns, iterations,
+                             lambda_max=self.lambda_max[level_index],
+                             inverse_diagonal=self.inverse_diagonal[level_index],
+                             residual=residual, return_residual=return_residual)
+        return jacobi(self.operators[level_index], rhs, unknowns, iterations,
+                      inverse_diagonal=self.inverse_diagonal[level_index], omega=self.omega,
+                      residual=residual, return_residual=return_residual)
+
+
+# Coarse-grid visits of one cycle: V once, W twice, F an F-cycle followed
+# by a V-cycle.
+CYCLES = {"V": ("V",), "W": ("W", "W"), "F": ("F", "V")}
+
+
+def cycle(storage, level, rhs, unknowns, cycle_type="V", pre_smoothing=5, post_smoothing=5,
+          residual=None, return_residual=False):
+    """One cycle on level. Like the smoothers it takes the residual of
+    unknowns if known and returns the new unknowns with their residual (None
+    unless return_residual). The residual of the pre-smoother is restricted
+    directly, and the coarse levels start from a zero guess, whose residual
+    is the right-hand side."""
+    level_index = level - storage.level_min
+    coarsest = level == storage.level_min
+    unknowns, residual = storage.smooth(level, rhs, unknowns, pre_smoothing, residual, return_residual=not coarsest)
+    if not coarsest:
+        rhs_coarse = storage.fine_to_coarse[level_index] @ residual
+        update = np.zeros(storage.stiffness[level_index - 1].shape[0])
+        residual_coarse = rhs_coarse
+        for coarse_cycle in CYCLES[cycle_type]:
+            update, _ = cycle(storage, level - 1, rhs_coarse, update, coarse_cycle, pre_smoothing, post_smoothing,
+                              residual=residual_coarse)
+            residual_coarse = None
+        # Correct
+        unknowns = unknowns + storage.coarse_to_fine[level_index] @ update
+    return storage.smooth(level, rhs, unknowns, post_smoothing, return_residual=return_residual)
+
+
+def v_cycle(storage, level, rhs, unknowns, pre_smoothing=5, post_smoothing=5):
+    return cycle(storage, level, rhs, unknowns, "V", pre_smoothing, post_smoothing)[0]
+
+
+def multigrid(storage, rhs, unknowns=None, tolerance=1e-6, max_cycles=100, **options):
+    """V-cycles on the finest level until the norm of the residual is below
+    tolerance, from a zero initial guess by default. Returns the solution
+    and the number of cycles.
+
+    The residual the post-smoother leaves behind serves both for the check
+    and for the next pre-smoother."""
+    if unknowns is None:
+        unknowns = np.zeros(storage.stiffness[-1].shape[0])
+        residual = rhs
+    else:
+        residual = rhs - storage.operators[-1] @ unknowns
+    for cycles in range(max_cycles):
+        if np.linalg.norm(residual) < tolerance:
+            return unknowns, cycles
+        unknowns, residual = cycle(storage, storage.level_max, rhs, unknowns, "V",
+                                   residual=residual, return_residual=True, **options)
+    return unknowns, max_cycles
+
+
+def full_multigrid(storage, rhs, cycles_per_level=1, cycle_type="V", pre_smoothing=5, post_smoothing=5):
+    """Nested iteration: solve exactly on level_min, then on every finer
+    level interpolate the solution as the initial guess and do
+    cycles_per_level cycles. The right-hand sides of the coarse levels are
+    the restrictions of rhs."""
+    number_of_levels = len(storage.stiffness)
+    rhs_per_level = [None] * number_of_levels
+    rhs_per_level[-1] = rhs
+    for level_index in range(number_of_levels - 1, 0, -1):
+        rhs_per_level[level_index - 1] = storage.fine_to_coarse[level_index] @ rhs_per_level[level_index]
+
+    unknowns = splinalg.spsolve(storage.stiffness[0].tocsc(), rhs_per_level[0])
+    for level_index in range(1, number_of_levels):
+        unknowns = storage.coarse_to_fine[level_index] @ unknowns
+        for i in range(cycles_per_level):
+            unknowns, _ = cycle(storage, storage.level_min + level_index, rhs_per_level[level_index], unknowns,
+                                cycle_type, pre_smoothing, post_smoothing)
+    return unknowns
+
+
+def cg(storage, rhs, unknowns=None, tolerance=1e-6, max_iter=100, flexible=False,
+       cycle_type="V", pre_smoothing=2, post_smoothing=2):
+    """Conjugate gradients on the finest level, preconditioned by one cycle
+    of cycle_type ("V", "W" or "F") from a zero guess. flexible=True uses
+    the Polak-Ribiere formula of flexible CG, which tolerates a
+    preconditioner that is not symmetric (for example unequal smoothing
+    counts). Stops once the norm of the residual is below tolerance.
+
+    Returns the solution and a dict with the iterations, the residual norms
+    and the wall-time of the solve.
+    """
+    if cycle_type not in CYCLES:
+        raise ValueError("unknown cycle type {}".format(cycle_type))
+    start = time.perf_counter()
+    stiffness = storage.operators[-1]
+    if unknowns is None:
+        unknowns = np.zeros(stiffness.shape[0])
+
+    def precondition(residual):
+        return cycle(storage, storage.level_max, residual, np.zeros_like(residual),
+                     cycle_type, pre_smoothing, post_smoothing, residual=residual)[0]
+
+    residual = rhs - stiffness @ unknowns
+    residuals = [np.linalg.norm(residual)]
+    iterations = 0
+    if residuals[-1] >= tolerance:
+        preconditioned = precondition(residual)
+        direction = preconditioned
+        rho = residual @ preconditioned
+        for iterations in range(1, max_iter + 1):
+            product = stiffness @ direction
+            alpha = rho / (direction @ product)
+            unknowns = unknowns + alpha * direction
+            residual_new = residual - alpha * product
+            residuals.append(np.linalg.norm(residual_new))
+            if residuals[-1] < tolerance:
+                break
+            preconditioned = precondition(residual_new)
+            rho_new = residual_new @ preconditioned
+            if flexible:
+                beta = (rho_new - residual @ preconditioned) / rho
+            else:
+                beta = rho_new / rho
+            direction = preconditioned + beta * direction
+            residual = residual_new
+            rho = rho_new
+    statistics = {
+        "iterations": iterations,
+        "residuals": np.array(residuals),
+        "time": time.perf_counter() - start,
+    }
+    return unknowns, statistics
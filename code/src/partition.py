@@ -0,0 +1,132 @@
+import argparse
+import sys
+
+import numpy as np
+from mpi4py import MPI
+
+import quadtree
+
+# Partition the cells of a uniform quadtree level across MPI ranks.
+# The cells of a level are numbered along a Morton (Z-order) curve,
+# see quadtree.morton_index, and every rank owns a contiguous range of
+# that curve. No rank ever holds more than its own part of the tree: the
+# cells of a range, their neighbours and their vertices all follow from
+# integer arithmetic on the lattice coordinates.
+#
+# Vertices are identified globally by their key i * (2**level + 1) + j
+# on the vertex lattice of the level.
+
+
+class Partition:
+    def __init__(self, level, ranges, rank):
+        self.level = level
+        self.rank = rank
+        # Rank r owns the cells ranges[r]:ranges[r+1] of the level
+        self.ranges = ranges
+
+        self.cells = np.arange(ranges[rank], ranges[rank + 1])
+        self.lattice = quadtree.morton_lattice(self.cells, level)
+
+        # Ghost layer: all cells that share a vertex with an owned cell.
+        n = 2**level
+        neighbours = (self.lattice[:, None, :] + quadtree.NEIGHBOUR_OFFSETS).reshape(-1, 2)
+        neighbours = neighbours[np.all((neighbours >= 0) & (neighbours < n), axis=1)]
+        neighbours = np.unique(quadtree.morton_index(neighbours, level))
+        self.ghost_cells = neighbours[(neighbours < ranges[rank]) | (neighbours >= ranges[rank + 1])]
+        self.ghost_lattice = quadtree.morton_lattice(self.ghost_cells, level)
+        self.ghost_cell_owners = self.owner(self.ghost_cells)
+
+        # A vertex belongs to the owner of the first cell around it, every
+        # vertex of the ghost layer that is not owned here is a ghost vertex.
+        corners = self.lattice[:, None, :] + quadtree.CORNER_OFFSETS
+        ghost_corners = self.ghost_lattice[:, None, :] + quadtree.CORNER_OFFSETS
+        all_corners = np.concatenate([corners, ghost_corners]).reshape(-1, 2)
+        vertices, first = np.unique(self.vertex_keys(all_corners), return_index=True)
+        owners = self.owner(self.first_cell(all_corners[first]))
+        self.owned_vertices = vertices[owners == rank]
+        self.ghost_vertices = vertices[owners != rank]
+        self.ghost_vertex_owners = owners[owners != rank]
+
+        # Local numbering: owned vertices first, then ghost vertices.
+        self.local_to_global = np.concatenate([self.owned_vertices, self.ghost_vertices])
+        self.global_order = np.argsort(self.local_to_global)
+
+        # Vertices of the owned and ghost cells in local numbering.
+        self.cell_vertices = self.global_to_local(self.vertex_keys(corners))
+        self.ghost_cell_vertices = self.global_to_local(self.vertex_keys(ghost_corners))
+
+    def vertex_keys(self, lattice):
+        return lattice[..., 0] * (2**self.level + 1) + lattice[..., 1]
+
+    def first_cell(self, vertex_lattice):
+        # Smallest index of the (up to four) cells around each vertex.
+        n = 2**self.level
+        first = np.full(len(vertex_lattice), np.iinfo(np.int64).max)
+        for offset in quadtree.CORNER_OFFSETS:
+            cell = vertex_lattice - offset
+            inside = np.all((cell >= 0) & (cell < n), axis=1)
+            first[inside] = np.minimum(first[inside], quadtree.morton_index(cell[inside], self.level))
+        return first
+
+    def owner(self, cells):
+        return np.searchsorted(self.ranges, cells, side="right") - 1
+
+    def global_to_local(self, vertices):
+        # Local index of global vertex keys, -1 if the vertex is not known here.
+        vertices = np.asarray(vertices)
+        position = np.searchsorted(self.local_to_global, vertices, sorter=self.global_order)
+        position = np.minimum(position, len(self.local_to_global) - 1)
+        local = self.global_order[position]
+        return np.where(self.local_to_global[local] == vertices, local, -1)
+
+
+def partition(level, comm=MPI.COMM_WORLD, weights=None):
+    """Split the cells of a uniform level in contiguous Morton ranges.
+
+    Without weights every rank gets the same number of cells (up to one).
+    weights is a callable that returns the weight of cells given their
+    (n, 2) centers. Each rank evaluates it only on an equal share of the
+    cells, and the ranges are cut so the weight per rank is balanced.
+    """
+    number_of_cells = 4**level
+    size = comm.size
+    initial = number_of_cells * np.arange(size + 1) // size
+    if weights is None:
+        return Partition(level, initial, comm.rank)
+
+    cells = np.arange(initial[comm.rank], initial[comm.rank + 1])
+    centers = (quadtree.morton_lattice(cells, level) + 0.5) / 2**level
+    w = np.asarray(weights(centers), dtype=np.float64)
+    local_weight = w.sum()
+    before = comm.exscan(local_weight)
+    if comm.rank == 0:
+        before = 0.0
+    total = comm.allreduce(local_weight)
+
+    # Cell i goes to the rank whose share of the total weight contains
+    # the middle of the cell's weight along the curve.
+    middle = before + np.cumsum(w) - 0.5 * w
+    owners = np.minimum((size * middle / total).astype(np.int64), size - 1)
+    counts = np.bincount(owners, minlength=size)
+    comm.Allreduce(MPI.IN_PLACE, counts, op=MPI.SUM)
+    ranges = np.concatenate([[0], np.cumsum(counts)])
+    return Partition(level, ranges, comm.rank)
+
+
+def main(name, *argv):
+    parser = argparse.ArgumentParser(
+        description="Partition a uniform quadtree level along the Morton curve")
+    parser.add_argument("level", type=int, help="Level of the quadtree")
+    parser.add_argument("--weighted", action="store_true",
+                        help="Weight cells by their distance from the origin")
+    args, _ = parser.parse_known_args(args=argv)
+    comm = MPI.COMM_WORLD
+    weights = (lambda centers: 1 + np.linalg.norm(centers, axis=1)) if args.weighted else None
+    part = partition(args.level, comm=comm, weights=weights)
+    print("Rank {}: cells {}:{}, {} ghost cells, {} owned and {} ghost vertices".format(
+        comm.rank, part.ranges[comm.rank], part.ranges[comm.rank + 1], len(part.ghost_cells),
+        len(part.owned_vertices), len(part.ghost_vertices)))
+
+
+if __name__ == "__main__":
+    main(*sys.argv)
@@ -1,28 +1,21 @@
+import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
 def plot_grid(fig, ax, grid, vertices=None, level=None, c='black', plot_center=False, plot_curve=False, plot_vertices=False):
-    xs = []
-    ys = []
-    vertices_xs = []
-    vertices_ys = []
-    for cell in grid.dfs(only_level=level):
-        xs.append(cell.center[0])
-        ys.append(cell.center[1])
-        if plot_center:
-            ax.scatter(cell.center[0], cell.center[1], c=c)
-        rect = patches.Rectangle(
-            cell.offset,
-            cell.size,
-            cell.size,
-            fill=False)
-        ax.add_patch(rect)
-        if plot_vertices:
-            for vertex_idx in cell.vertices:
-                vertex_coords = vertices[vertex_idx]
-                vertices_xs.append(vertex_coords[0])
-                vertices_ys.append(vertex_coords[1])
+    if level is None:
+        levels = range(grid.level, grid.get_max_level() + 1)
+    else:
+        levels = [level]
+    centers = np.concatenate([grid.level_centers(l) for l in levels])
+    sizes = np.concatenate([grid.level_sizes(l) for l in levels])
+    offsets = centers - 0.5 * sizes[:, None]
+    corners = offsets[:, None, :] + sizes[:, None, None] * np.array([[0, 0], [1, 0], [1, 1], [0, 1]])
+    ax.add_collection(PolyCollection(corners, facecolors='none', edgecolors='black'))
+    if plot_center:
+        ax.scatter(centers[:, 0], centers[:, 1], c=c)
     if plot_curve:
-        ax.plot(xs, ys, c=c)
+        ax.plot(centers[:, 0], centers[:, 1], c=c)
     if plot_vertices:
+        cell_vertices = np.concatenate([grid.level_vertices(l) for l in levels])
+        vertices_xs, vertices_ys = np.array([vertices[v] for v in cell_vertices.ravel()]).reshape(-1, 2).T
         ax.scatter(vertices_xs, vertices_ys, c='red', marker='x', s=100)
-    
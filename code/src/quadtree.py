@@ -1,9 +1,28 @@
 import numpy as np
-from collections import defaultdict
+
+# Vertices are identified by integer coordinates on the grid of this level,
+# which is exact for every tree that is not deeper than it.
+LATTICE_LEVEL = 30
+
+# Lattice offsets of the four children of a cell, in the order of split().
+CHILD_OFFSETS = np.array([[0, 1], [1, 1], [0, 0], [1, 0]])
+
+# Lattice offsets of the eight cells around a cell, in the order of the
+# columns of level_neighbours().
+WEST, EAST, SOUTH, NORTH, SOUTH_WEST, SOUTH_EAST, NORTH_WEST, NORTH_EAST = range(8)
+NEIGHBOUR_OFFSETS = np.array([[-1, 0], [1, 0], [0, -1], [0, 1],
+                              [-1, -1], [1, -1], [-1, 1], [1, 1]])
+
+# Lattice offsets of the four corners of a cell, in the order of
+# get_cell_vertices().
+CORNER_OFFSETS = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
+
+# Edges of a cell as pairs of corners: left, right, bottom, top.
+EDGES = np.array([[0, 1], [2, 3], [0, 2], [1, 3]])
 
 
 class Quadtree:
-    def __init__(self,center, size, level=0, parent=None):
+    def __init__(self,center, size, level=0, parent=None, lattice=(0, 0)):
         self.center = center
         self.size = size
         self.offset = center - 0.5 * size
@@ -15,8 +34,22 @@ class Quadtree:
         self.parent = parent
         self.vertices = [None, None, None, None]
         self.index = -1 # index if level treated as max level
-        
+        self.lattice = np.asarray(lattice) # integer coordinates in the grid of this level
+        self.max_level = level # of the subtree rooted here
+        self.clear_caches()
+        self.vertex_keys = None # lattice keys of the numbered vertices
+
     def split(self):
+        max_level = self._split()
+        # The subtrees of all ancestors have changed as well.
+        ptr = self.parent
+        while ptr is not None:
+            ptr.max_level = max(ptr.max_level, max_level)
+            ptr.clear_caches()
+            ptr = ptr.parent
+        return max_level
+
+    def _split(self):
         max_level = self.level
         new_size = self.size / 2
         offsets = [
@@ -38,25 +71,171 @@ class Quadtree:
                     center = new_center,
                     size = new_size,
                     level = new_level,
-                    parent=self)
+                    parent=self,
+                    lattice=2 * self.lattice + CHILD_OFFSETS[i])
             else:
-                new_level = self.children[i].split()
+                new_level = self.children[i]._split()
             max_level = max(max_level, new_level)
             
         self.is_leaf = False
+        self.max_level = max_level
+        self.clear_caches()
         
         return max_level
     
     def get_max_level(self):
-        return max(c.level for c in self.dfs())
+        return self.max_level
+
+    def clear_caches(self):
+        self.cells_per_level = [[self]] # cells of level self.level + i
+        self.leaves = None # leaves in dfs order
+        self.neighbours_per_level = dict()
     
     def split_to_level(self, level):
         max_level = self.get_max_level()
+        if max_level < level and self.is_uniform():
+            return self.split_uniform_to_level(level)
         while (max_level < level):
             max_level = self.split()
         return max_level
-        
+
+    def is_uniform(self):
+        # All leaves are on the deepest level.
+        return len(self.get_cells(self.max_level)) == 4**(self.max_level - self.level)
+
+    def split_uniform_to_level(self, level):
+        # The cells of all new levels follow in closed form from those of
+        # the deepest level, so they are created level by level instead of
+        # recursing through the whole tree for every level.
+        root = self.find_root()
+        max_level = self.max_level
+        for cell in self.dfs():
+            cell.max_level = level
+            cell.clear_caches()
+        parents = self.get_cells(max_level)
+        lattice = np.array([cell.lattice for cell in parents])
+        for new_level in range(max_level + 1, level + 1):
+            lattice = child_lattice(lattice)
+            size = root.size / 2**new_level
+            centers = root.offset + (lattice + 0.5) * size
+            children = [
+                Quadtree(center=center, size=size, level=new_level, parent=parents[i // 4], lattice=cell_lattice)
+                for i, (center, cell_lattice) in enumerate(zip(centers, lattice))]
+            for i, parent in enumerate(parents):
+                parent.children = children[4 * i:4 * i + 4]
+                parent.is_leaf = False
+                parent.max_level = level
+            parents = children
+
+        ptr = self
+        while ptr is not None:
+            ptr.max_level = max(ptr.max_level, level)
+            ptr.clear_caches()
+            ptr = ptr.parent
+        return level
+
+    def find_leaf(self, lattice, level):
+        # Deepest cell of at most the given level that contains the cell
+        # with the given lattice coordinates, None outside of the tree.
+        if np.any((lattice < 0) | (lattice >= 2**level)):
+            return None
+        ptr = self
+        for bit in range(level - 1, -1, -1):
+            if ptr.is_leaf:
+                break
+            i = (lattice[0] >> bit) & 1
+            j = (lattice[1] >> bit) & 1
+            ptr = ptr.children[2 * (1 - j) + i]
+        return ptr
+
+    def refine(self, cells):
+        """Split the given leaves of the tree and balance it.
+
+        Leaves are split further until leaves that share a face or a corner
+        differ by at most one level. Vertices of the new cells are appended
+        to the numbering from get_vertices, existing vertices keep their
+        index. Returns the new cells.
+        """
+        root = self.find_root()
+        new_cells = []
+        stack = list(cells)
+        while stack:
+            cell = stack.pop()
+            if not cell.is_leaf:
+                continue
+            # Children of the cell would be too fine for coarser neighbours.
+            coarser = []
+            for offset in NEIGHBOUR_OFFSETS:
+                leaf = root.find_leaf(cell.lattice + offset, cell.level)
+                if leaf is not None and leaf.level < cell.level:
+                    coarser.append(leaf)
+            if coarser:
+                stack.append(cell)
+                stack.extend(coarser)
+                continue
+            cell.split()
+            new_cells.extend(cell.children)
+
+        if root.vertex_keys is not None and new_cells:
+            lattice = np.array([cell.lattice for cell in new_cells])
+            levels = np.array([cell.level for cell in new_cells])
+            cell_keys = lattice_keys(corner_lattice(lattice, levels))
+            position = np.searchsorted(root.sorted_vertex_keys, cell_keys)
+            is_known = root.sorted_vertex_keys[np.minimum(position, len(root.vertex_keys) - 1)] == cell_keys
+            new_keys = new_vertex_keys(cell_keys[~is_known], root.vertex_keys[:0])
+            root.add_vertex_keys(new_keys)
+
+            position = np.searchsorted(root.sorted_vertex_keys, cell_keys)
+            for cell, cell_vertices in zip(new_cells, root.sorted_vertex_indices[position].tolist()):
+                cell.vertices = cell_vertices
+        return new_cells
+
+    def add_vertex_keys(self, keys):
+        # Append vertices to the numbering, keeping a sorted copy for lookups.
+        self.sorted_vertex_keys, self.sorted_vertex_indices = insert_sorted_keys(
+            self.sorted_vertex_keys, self.sorted_vertex_indices, keys, len(self.vertex_keys))
+        self.vertex_keys = np.concatenate([self.vertex_keys, keys])
+
+    def get_hanging_vertices(self):
+        """Return the vertices of leaves that lie in the middle of an edge of
+        a coarser leaf, and the (n, 2) vertices at the ends of that edge.
+        The value of a hanging vertex is the mean of the two."""
+        leaves = self.get_cells(None)
+        lattice = np.array([cell.lattice for cell in leaves])
+        levels = np.array([cell.level for cell in leaves])
+        corners = corner_lattice(lattice, levels)
+        ends = corners[:, EDGES]
+        midpoint_keys = lattice_keys(ends.sum(axis=2) // 2)
+        is_hanging = np.isin(midpoint_keys, lattice_keys(corners))
+        hanging_keys, first = np.unique(midpoint_keys[is_hanging], return_index=True)
+        ends_keys = lattice_keys(ends[is_hanging][first])
+
+        root = self.find_root()
+        def vertex_index(keys):
+            return root.sorted_vertex_indices[np.searchsorted(root.sorted_vertex_keys, keys)]
+        return vertex_index(hanging_keys), vertex_index(ends_keys)
+
+    def get_cells(self, level):
+        # Cells of the given level in the order of dfs(only_level=level),
+        # or all leaves in dfs order if level is None.
+        # Children of earlier cells come first, so each level is built
+        # from the one above.
+        if level is None:
+            if self.leaves is None:
+                self.leaves = [cell for cell in self.dfs() if cell.is_leaf]
+            return self.leaves
+        if not self.level <= level <= self.max_level:
+            return []
+        while len(self.cells_per_level) <= level - self.level:
+            self.cells_per_level.append(
+                [child for cell in self.cells_per_level[-1]
+                 for child in cell.children if child is not None])
+        return self.cells_per_level[level - self.level]
+
     def dfs(self, only_level=None):
+        if only_level is not None:
+            yield from self.get_cells(only_level)
+            return
         for child in self.children:
             if child is not None:
                 yield from child.dfs(only_level=only_level)
@@ -70,100 +249,77 @@ class Quadtree:
         return ptr
     
     def is_inside(self, point, eps=1e-6):
-        #print("Searching for {}".format(point))
-        if self.is_leaf:
-            print("In leaf")
         left = self.offset[0]
-        right = self.offset[0] + size
-        top = self.offset[1] + size
+        right = self.offset[0] + self.size
+        top = self.offset[1] + self.size
         bottom = self.offset[1]
-        #print("left = {}, right = {}, top = {}, bottom {}".format(
-        #left, right,top,bottom))
-        #print()
         return (
             (left - point[0]) <= eps and
-            (right - point[0]) >= eps and
+            (point[0] - right) <= eps and
             (bottom - point[1]) <= eps and
-            (top - point[1]) >= eps
+            (point[1] - top) <= eps
         )
-            
-    
-    def find_cell(self, point, eps, originator=None):
-        if originator is None:
-            originator = self
-            ptr = self.find_root()
-            # Handle case of level 0
-            if ptr.is_leaf:
-                return None
-        else:
-            ptr = self
-            
-        print(self.center)
-        if self.is_leaf:
-            assert(self.is_inside(point, eps=eps))
-            assert(self is not originator)
-            return self
-        
-        for child in ptr.children:
-            if child is None:
-                continue
-            elif child is not originator and child.is_inside(point):
-                result_child = child.find_cell(point, eps, originator)
-                if result_child is not None:
-                    return result_child
-        return None
-            
-        
-    def get_cell_vertices(self, rounded_decimals=6):
-        # TODO Fix order of vertices
-        factors = [-1, 1]
-        for f1 in factors:
-            for f2 in factors:
-                # 0 0 -1.0 -1.0
-                # 0 1 -1.0 1.0
-                # 1 0 1.0 -1.0
-                # 1 1 1.0 1.0
-                yield tuple(
-                    np.round(
-                        np.array([self.center[0]+f1 * self.size / 2,
-                                  self.center[1] + f2 * self.size / 2]), decimals=rounded_decimals))
-
-    def get_vertices(self,):           
-        cur_idx = 0
+
+    def locate(self, points, level=None):
+        # Index among the cells of the level that contain the (n, 2) points,
+        # -1 for points outside of this cell. Without a level, a uniform
+        # tree uses its deepest level and a refined tree its leaves, in the
+        # order of get_cells(None).
+        if level is None and not self.is_uniform():
+            leaves = self.get_cells(None)
+            levels = np.array([cell.level for cell in leaves]) - self.level
+            lattice = np.array([cell.lattice for cell in leaves]) - (self.lattice[None, :] << levels[:, None])
+            return locate_leaves(points, self.offset, self.size, lattice, levels)
+        if level is None:
+            level = self.get_max_level()
+        if len(self.get_cells(level)) != 4**(level - self.level):
+            raise ValueError("level {} is not complete, locate the leaves with level=None".format(level))
+        return locate(points, self.offset, self.size, level - self.level)
+
+    def find_cell(self, point, level=None):
+        # Cell of the level containing the point, by default the deepest
+        # cell (see locate).
+        index = self.locate(np.array([point]), level)[0]
+        if index < 0:
+            return None
+        # On a uniform tree the leaves are the cells of the deepest level.
+        return self.get_cells(level)[index]
+
+    def get_vertices(self,):
         max_level = self.get_max_level()
-        vertices = dict() # coord -> idx
-        count_before = 0
-        number_of_vertices_per_level = []
-        boundary_vertices = set()
-        for level in range(max_level+1):
-            vertices_count = defaultdict(int) # idx -> how many cells this vertex is member of
-            count_before = len(vertices)
-            for cell in self.dfs(only_level=level):
-                cell.vertices = []
-                for vertex_coord in cell.get_cell_vertices(rounded_decimals=max_level+1): # TODO fix rounding
-                    if not vertex_coord in vertices:
-                        vertex_idx = cur_idx
-                        vertices[vertex_coord] = vertex_idx
-                        cur_idx += 1
-                    else:
-                        vertex_idx = vertices[vertex_coord]
-
-                    cell.vertices.append(vertex_idx)
-                    vertices_count[vertex_idx] += 1
-            number_of_vertices_per_level.append(len(vertices))
-            #print("Level {} has \t{} vertices".format(level, len(vertices) - count_before))
-                
-            boundary_vertices |= set([i for (i,j) in vertices_count.items() if j < 4])
-            #print(vertices_count)
-        return vertices, np.array(number_of_vertices_per_level), boundary_vertices
-    
+        cells_per_level = [self.get_cells(level) for level in range(max_level+1)]
+        cell_lattices = [np.array([cell.lattice for cell in cells]).reshape(-1, 2) for cells in cells_per_level]
+        if self.parent is None and self.is_uniform():
+            keys, cell_vertices, number_of_vertices_per_level = uniform_vertices(cell_lattices)
+        else:
+            keys, cell_vertices, number_of_vertices_per_level = number_vertices(cell_lattices)
+        for cells, vertices in zip(cells_per_level, cell_vertices):
+            for cell, cell_vertex in zip(cells, vertices.tolist()):
+                cell.vertices = cell_vertex
+
+        root = self.find_root()
+        root.vertex_keys = keys[:0]
+        root.sorted_vertex_keys = keys[:0]
+        root.sorted_vertex_indices = keys[:0]
+        root.add_vertex_keys(keys)
+        vertices, boundary_vertices = vertex_maps(keys, root.offset, root.size)
+        return vertices, number_of_vertices_per_level, boundary_vertices
+
     def set_all_cell_vertices(self, vertices_map):
-        max_level = self.get_max_level()
-        for cell in self.dfs():
-            for i, vertex_coord in enumerate(cell.get_cell_vertices(rounded_decimals=max_level+1)): # TODO fix rounding
-                    assert(vertex_coord in vertices_map)
-                    cell.vertices[i] = vertices_map[vertex_coord]
-                    
+        root = self.find_root()
+        # Coordinates in the map are exact multiples of the lattice spacing.
+        coords = np.array(list(vertices_map.keys())).reshape(-1, 2)
+        keys = lattice_keys(np.rint((coords - root.offset) * (2**LATTICE_LEVEL / root.size)).astype(np.int64))
+        indices = np.array(list(vertices_map.values()), dtype=np.int64)
+        order = np.argsort(keys)
+        for level in range(self.level, self.get_max_level()+1):
+            cells = self.get_cells(level)
+            cell_keys = lattice_keys(corner_lattice(np.array([cell.lattice for cell in cells]), level))
+            position = np.searchsorted(keys, cell_keys, sorter=order)
+            assert np.all(keys[order[np.minimum(position, len(keys) - 1)]] == cell_keys)
+            for cell, cell_vertices in zip(cells, indices[order[position]].tolist()):
+                cell.vertices = cell_vertices
+
     def set_all_cell_indices(self):
         # for each level
         max_level = self.get_max_level()
@@ -171,7 +327,368 @@ class Quadtree:
             for i, cell in enumerate(self.dfs(only_level=level)):
                     cell.index = i
 
-                    
+
+    def level_centers(self, level):
+        return np.array([cell.center for cell in self.get_cells(level)]).reshape(-1, 2)
+
+    def level_sizes(self, level):
+        return np.array([cell.size for cell in self.get_cells(level)])
+
+    def level_vertices(self, level):
+        return np.array([cell.vertices for cell in self.get_cells(level)],
+                        dtype=np.int64).reshape(-1, 4)
+
+    def level_parents(self, level):
+        # Index of the parent of each cell among the cells of level - 1.
+        return np.array([-1 if cell.parent is None else cell.parent.index
+                         for cell in self.get_cells(level)], dtype=np.int64)
+
+    def to_compact(self):
+        # Same uniformly refined tree as a CompactQuadtree.
+        assert self.parent is None and self.is_uniform()
+        compact = CompactQuadtree(center=self.center, size=self.size)
+        compact.split_to_level(self.max_level)
+        compact.vertices = np.concatenate([self.level_vertices(level) for level in range(self.max_level + 1)])
+        if self.vertex_keys is not None:
+            compact.vertex_lattice = vertex_lattice(self.vertex_keys)
+            compact.vertex_coords = self.offset + compact.vertex_lattice * (self.size / 2**LATTICE_LEVEL)
+            compact.number_of_vertices_per_level = np.maximum.accumulate(
+                [self.level_vertices(level).max() + 1 for level in range(self.max_level + 1)])
+        return compact
+
+    def level_neighbours(self, level):
+        if level not in self.neighbours_per_level:
+            lattice = np.array([cell.lattice for cell in self.get_cells(level)]).reshape(-1, 2)
+            self.neighbours_per_level[level] = neighbour_table(lattice, level)
+        return self.neighbours_per_level[level]
+
+
+def neighbour_table(lattice, level):
+    """Index of the eight neighbours of each of the cells of a level with
+    the given (n, 2) lattice coordinates, in the order of NEIGHBOUR_OFFSETS.
+    Neighbours outside of the domain or missing from the level are -1."""
+    neighbour_lattice = lattice[:, None, :] + NEIGHBOUR_OFFSETS
+    if len(lattice) == 4**level:
+        # Complete level: look the cells up in a table padded with -1.
+        index = np.full((2**level + 2, 2**level + 2), -1, dtype=np.int64)
+        index[lattice[:, 0] + 1, lattice[:, 1] + 1] = np.arange(len(lattice))
+        return index[neighbour_lattice[..., 0] + 1, neighbour_lattice[..., 1] + 1]
+    keys = lattice_keys(lattice)
+    order = np.argsort(keys)
+    neighbour_keys = lattice_keys(neighbour_lattice)
+    position = np.minimum(np.searchsorted(keys, neighbour_keys, sorter=order), len(keys) - 1)
+    neighbours = order[position]
+    outside = np.any((neighbour_lattice < 0) | (neighbour_lattice >= 2**level), axis=-1)
+    neighbours[outside | (keys[neighbours] != neighbour_keys)] = -1
+    return neighbours
+
+
+def morton_index(lattice, level):
+    """Index of the cells with the given (n, 2) lattice coordinates among the
+    cells of their level. Each level adds one base-4 digit, the position of
+    the cell among the children of its parent."""
+    index = np.zeros(len(lattice), dtype=np.int64)
+    for bit in range(level - 1, -1, -1):
+        i = (lattice[:, 0] >> bit) & 1
+        j = (lattice[:, 1] >> bit) & 1
+        index = 4 * index + 2 * (1 - j) + i
+    return index
+
+
+def morton_lattice(index, level):
+    # Lattice coordinates of the cells with the given index among the cells
+    # of a uniform level, the inverse of morton_index.
+    lattice = np.zeros((len(index), 2), dtype=np.int64)
+    for bit in range(level - 1, -1, -1):
+        lattice = 2 * lattice + CHILD_OFFSETS[(index >> (2 * bit)) & 3]
+    return lattice
+
+
+def locate(points, offset, size, level):
+    # Index of the cells of a uniform level containing the points,
+    # -1 for points outside of the square [offset, offset + size]^2.
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    number_of_cells = 2**level
+    inside = np.all((points >= offset) & (points <= offset + size), axis=1)
+    lattice = np.floor((points - offset) * (number_of_cells / size)).astype(np.int64)
+    # Points on the upper boundary belong to the last cell.
+    lattice = np.clip(lattice, 0, number_of_cells - 1)
+    return np.where(inside, morton_index(lattice, level), -1)
+
+
+def locate_leaves(points, offset, size, lattice, levels):
+    # Index of the leaves, given by their lattice coordinates and levels in
+    # dfs order, that contain the points, -1 for points outside. Each leaf
+    # covers a range of the Morton indices of the deepest level, which
+    # starts at its top left descendant, and the dfs order sorts these
+    # ranges.
+    max_level = levels.max()
+    index = locate(points, offset, size, max_level)
+    scale = 1 << (max_level - levels)
+    top_left = np.stack([lattice[:, 0] * scale, (lattice[:, 1] + 1) * scale - 1], axis=-1)
+    starts = morton_index(top_left, max_level)
+    return np.where(index >= 0, np.searchsorted(starts, index, side="right") - 1, -1)
+
+
+def insert_sorted_keys(sorted_keys, sorted_indices, keys, start):
+    # Add the keys of the vertices start, start + 1, ... to the sorted keys
+    # and their vertex indices.
+    order = np.argsort(keys)
+    position = np.searchsorted(sorted_keys, keys[order])
+    return np.insert(sorted_keys, position, keys[order]), np.insert(sorted_indices, position, start + order)
+
+
+def lattice_keys(lattice):
+    # Unique integer key of each lattice point, lattice has shape (..., 2).
+    return lattice[..., 0] * (2**LATTICE_LEVEL + 1) + lattice[..., 1]
+
+
+def corner_lattice(cell_lattice, level):
+    # Corners of cells on the vertex lattice, shape (n, 4, 2).
+    # level is the level of all cells or an array with one per cell.
+    shift = LATTICE_LEVEL - np.asarray(level)
+    return (cell_lattice[:, None, :] + CORNER_OFFSETS) << shift[..., None, None]
+
+
+def new_vertex_keys(keys, known_keys):
+    """Return the keys of (n, 4) that are not in known_keys, ordered by
+    their first appearance in keys."""
+    flat = keys.ravel()
+    unique, first = np.unique(flat, return_index=True)
+    is_new = ~np.isin(unique, known_keys, assume_unique=True)
+    return flat[np.sort(first[is_new])]
+
+
+def number_vertices(cell_lattices):
+    """Number the vertices of all levels, given the lattice coordinates of
+    the cells of each level in traversal order.
+
+    Vertices are numbered level by level in order of first appearance, so
+    the vertices of level l are the first number_of_vertices_per_level[l].
+    Returns the vertex keys in numbering order, the (n, 4) vertices of the
+    cells of each level and the number of vertices per level.
+    """
+    keys = np.zeros(0, dtype=np.int64)
+    cell_vertices = []
+    number_of_vertices_per_level = []
+    for level, lattice in enumerate(cell_lattices):
+        cell_keys = lattice_keys(corner_lattice(lattice, level))
+        keys = np.concatenate([keys, new_vertex_keys(cell_keys, keys)])
+        order = np.argsort(keys)
+        cell_vertices.append(order[np.searchsorted(keys, cell_keys, sorter=order)])
+        number_of_vertices_per_level.append(len(keys))
+    return keys, cell_vertices, np.array(number_of_vertices_per_level)
+
+
+def uniform_vertices(cell_lattices):
+    """Same as number_vertices for the levels of a uniformly refined tree.
+
+    A vertex first appears in the first cell of its level that contains
+    it. The cells around each lattice point are looked up in a table of
+    cell indices, so the numbering needs no sort of all corners.
+    """
+    vertex_ids = None
+    keys = []
+    cell_vertices = []
+    number_of_vertices_per_level = []
+    number_of_vertices = 0
+    for level, lattice in enumerate(cell_lattices):
+        vertex_ids, new_keys, level_vertices = number_uniform_level(
+            lattice, level, vertex_ids, number_of_vertices)
+        number_of_vertices += len(new_keys)
+        keys.append(new_keys)
+        cell_vertices.append(level_vertices)
+        number_of_vertices_per_level.append(number_of_vertices)
+    return np.concatenate(keys), cell_vertices, np.array(number_of_vertices_per_level)
+
+
+def number_uniform_level(lattice, level, vertex_ids, number_of_vertices):
+    """Number the vertices of one level of a uniform tree.
+
+    vertex_ids holds the vertex index at each lattice point of the level
+    above (None for level 0), the new vertices are numbered from
+    number_of_vertices on. Returns the table of vertex indices of this
+    level, the keys of the new vertices and the vertices of the cells.
+    """
+    n = 2**level
+    level_ids = np.full((n + 1, n + 1), -1, dtype=np.int64)
+    if vertex_ids is not None:
+        level_ids[::2, ::2] = vertex_ids
+    cell_index = np.full((n + 2, n + 2), np.iinfo(np.int64).max // 8)
+    cell_index[lattice[:, 0] + 1, lattice[:, 1] + 1] = np.arange(len(lattice))
+    # Position 4 * cell + corner of the first appearance of each point,
+    # the point is corner 3 of the cell below left, 2 of the cell above
+    # left, 1 of the cell below right and 0 of the cell above right.
+    first = np.minimum(
+        np.minimum(4 * cell_index[:-1, :-1] + 3, 4 * cell_index[:-1, 1:] + 2),
+        np.minimum(4 * cell_index[1:, :-1] + 1, 4 * cell_index[1:, 1:]))
+
+    is_new = (level_ids == -1).ravel()
+    new = np.flatnonzero(is_new)[np.argsort(first.ravel()[is_new])]
+    level_ids.flat[new] = np.arange(number_of_vertices, number_of_vertices + len(new))
+
+    new_lattice = np.stack(np.divmod(new, n + 1), axis=-1) << (LATTICE_LEVEL - level)
+    corners = lattice[:, None, :] + CORNER_OFFSETS
+    return level_ids, lattice_keys(new_lattice), level_ids[corners[..., 0], corners[..., 1]]
+
+
+def child_lattice(lattice):
+    # Lattice coordinates of the children of cells, in the order of split().
+    return (2 * lattice[:, None, :] + CHILD_OFFSETS).reshape(-1, 2)
+
+
+def vertex_lattice(keys):
+    return np.stack(np.divmod(keys, 2**LATTICE_LEVEL + 1), axis=-1)
+
+
+def vertex_maps(keys, offset, size, start=0):
+    # Map from coordinates to vertex index and the vertices on the boundary,
+    # for vertices numbered from start.
+    lattice = vertex_lattice(keys)
+    coords = offset + lattice * (size / 2**LATTICE_LEVEL)
+    on_boundary = np.any((lattice == 0) | (lattice == 2**LATTICE_LEVEL), axis=1)
+    vertices = dict(zip(map(tuple, coords.tolist()), range(start, start + len(keys))))
+    return vertices, set((start + np.flatnonzero(on_boundary)).tolist())
+
+
+class CompactQuadtree:
+    """Uniformly refined quadtree stored as a structure of arrays.
+
+    Row i of each array describes cell i. Cells are numbered level by
+    level, and within a level in the order of Quadtree.dfs(only_level).
+    """
+    arrays = ("centers", "sizes", "levels", "parents", "children", "lattice",
+              "vertices", "level_offsets", "vertex_lattice", "vertex_coords",
+              "number_of_vertices_per_level")
+
+    def __init__(self, center, size):
+        self.center = center
+        self.size = size
+        self.offset = center - 0.5 * size
+        self.level = 0
+
+        self.centers = np.array([center], dtype=np.float64)
+        self.sizes = np.array([size], dtype=np.float64)
+        self.levels = np.zeros(1, dtype=np.int64)
+        self.parents = np.full(1, -1, dtype=np.int64)
+        self.children = np.full((1, 4), -1, dtype=np.int64)
+        # Integer coordinates of the cell in the grid of its own level
+        self.lattice = np.zeros((1, 2), dtype=np.int64)
+        self.vertices = np.full((1, 4), -1, dtype=np.int64)
+        # Cells of level l are level_offsets[l]:level_offsets[l+1]
+        self.level_offsets = np.array([0, 1], dtype=np.int64)
+
+        self.vertex_lattice = np.zeros((0, 2), dtype=np.int64)
+        self.vertex_coords = np.zeros((0, 2), dtype=np.float64)
+        # The vertices of levels 0..len(number_of_vertices_per_level)-1 are
+        # numbered, vertex_ids holds their indices on the deepest lattice.
+        self.number_of_vertices_per_level = np.zeros(0, dtype=np.int64)
+        self.vertex_ids = None
+        # The levels of a uniform tree never change, so neither do these.
+        self.neighbours_per_level = dict()
+
+    def level_range(self, level):
+        return slice(self.level_offsets[level], self.level_offsets[level + 1])
+
+    def split(self):
+        return self.split_to_level(self.get_max_level() + 1)
+
+    def get_max_level(self):
+        return len(self.level_offsets) - 2
+
+    def locate(self, points, level=None):
+        # Index among the cells of the level (the deepest by default) that
+        # contain the (n, 2) points, -1 for points outside of the tree.
+        if level is None:
+            level = self.get_max_level()
+        return locate(points, self.offset, self.size, level)
+
+    def split_to_level(self, level):
+        # All cells of the new levels follow in closed form from the
+        # cells of the deepest level.
+        max_level = self.get_max_level()
+        if max_level >= level:
+            return max_level
+        lattices = [self.lattice[self.level_range(max_level)]]
+        for new_level in range(max_level + 1, level + 1):
+            lattices.append(child_lattice(lattices[-1]))
+        starts = self.level_offsets[-2] + np.cumsum([0] + [len(lattice) for lattice in lattices])
+        number_of_new_cells = starts[-1] - self.level_offsets[-1]
+        lattice = np.concatenate(lattices[1:])
+        levels = np.concatenate([np.full(len(lattices[i]), max_level + i) for i in range(1, len(lattices))])
+        sizes = self.size / 2.0**levels
+
+        self.children[self.level_range(max_level)] = np.arange(starts[1], starts[2]).reshape(-1, 4)
+        children = np.full((number_of_new_cells, 4), -1, dtype=np.int64)
+        children[:starts[-2] - starts[1]] = np.arange(starts[2], starts[-1]).reshape(-1, 4)
+        self.centers = np.concatenate([self.centers, self.offset + (lattice + 0.5) * sizes[:, None]])
+        self.sizes = np.concatenate([self.sizes, sizes])
+        self.levels = np.concatenate([self.levels, levels])
+        self.parents = np.concatenate([self.parents, np.repeat(np.arange(starts[0], starts[-2]), 4)])
+        self.children = np.concatenate([self.children, children])
+        self.lattice = np.concatenate([self.lattice, lattice])
+        self.vertices = np.concatenate([self.vertices, np.full((number_of_new_cells, 4), -1)])
+        self.level_offsets = np.concatenate([self.level_offsets[:-1], starts[1:]])
+        return level
+
+    def get_vertices(self):
+        max_level = self.get_max_level()
+        self.number_vertices_to_level(max_level)
+        vertices, boundary_vertices = vertex_maps(lattice_keys(self.vertex_lattice), self.offset, self.size)
+        return vertices, self.number_of_vertices_per_level[:max_level + 1], boundary_vertices
+
+    def number_vertices_to_level(self, level):
+        # Split and number the vertices of the levels up to level that are
+        # not numbered yet, the vertices of coarser levels keep their index.
+        self.split_to_level(level)
+        numbered_levels = len(self.number_of_vertices_per_level)
+        if self.vertex_ids is None and numbered_levels > 0:
+            # Loaded from a file, rebuild the table of the deepest level
+            n = 2**(numbered_levels - 1)
+            lattice = self.vertex_lattice >> (LATTICE_LEVEL - numbered_levels + 1)
+            self.vertex_ids = np.full((n + 1, n + 1), -1, dtype=np.int64)
+            self.vertex_ids[lattice[:, 0], lattice[:, 1]] = np.arange(len(lattice))
+        for level in range(numbered_levels, level + 1):
+            self.vertex_ids, keys, cell_vertices = number_uniform_level(
+                self.lattice[self.level_range(level)], level, self.vertex_ids, len(self.vertex_lattice))
+            self.vertices[self.level_range(level)] = cell_vertices
+            new_lattice = vertex_lattice(keys)
+            self.vertex_lattice = np.concatenate([self.vertex_lattice, new_lattice])
+            self.vertex_coords = np.concatenate([
+                self.vertex_coords, self.offset + new_lattice * (self.size / 2**LATTICE_LEVEL)])
+            self.number_of_vertices_per_level = np.append(
+                self.number_of_vertices_per_level, len(self.vertex_lattice))
+        return self.number_of_vertices_per_level[level]
+
+    def set_all_cell_vertices(self, vertices_map):
+        # The vertices of all cells are already stored by get_vertices.
+        pass
+
+    def set_all_cell_indices(self):
+        # The index of a cell within its level is implicit in the layout.
+        pass
+
+    def level_centers(self, level):
+        return self.centers[self.level_range(level)]
+
+    def level_sizes(self, level):
+        return self.sizes[self.level_range(level)]
+
+    def level_vertices(self, level):
+        return self.vertices[self.level_range(level)]
+
+    def level_parents(self, level):
+        parents = self.parents[self.level_range(level)]
+        if level == 0:
+            return parents
+        return parents - self.level_offsets[level - 1]
+
+    def level_neighbours(self, level):
+        if level not in self.neighbours_per_level:
+            self.neighbours_per_level[level] = neighbour_table(self.lattice[self.level_range(level)], level)
+        return self.neighbours_per_level[level]
+
+
 def get_number_of_cells(level):
     return 4**level
 
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+import fem
+import geometry as geo
+import multigrid as mg
+
+DIRICHLET = {
+    "top": lambda vertex: vertex[1] > 1.0 - 1e-8,
+    "top and left": lambda vertex: vertex[1] > 1.0 - 1e-8 or vertex[0] < 1e-8,
+    "all": lambda vertex: min(vertex[0], vertex[1], 1.0 - vertex[0], 1.0 - vertex[1]) < 1e-8,
+}
+
+
+# The construction of the notebooks (2DMultigrid.ipynb): evaluate the basis
+# functions of the parent at each vertex of the fine cells.
+def evaluate_solution(geometry, discretization, cell, coord):
+    x, y = fem.map_to_reference_coordinates(cell, coord)
+    coeff = dict()
+    for linear_index, vert in enumerate(cell.vertices):
+        if vert not in geometry.dirichlet_vertices:
+            coeff[vert] = fem.lagrange_2d(discretization.nodes_x, linear_index, np.array([x, y]))
+    return coeff
+
+
+def notebook_interpolation(geometry, level_coarse):
+    level_fine = level_coarse + 1
+    discretization = fem.Discretization(geometry, level_fine)
+    interpolation = sp.lil_matrix(
+        (geometry.data_size_per_level[level_fine], geometry.data_size_per_level[level_coarse]), dtype=np.float64)
+    for cell in geometry.grid.dfs(only_level=level_fine):
+        for vert in cell.vertices:
+            if vert in geometry.dirichlet_vertices:
+                continue
+            coords = geometry.vertices_idx_to_coords[vert]
+            coeffs = evaluate_solution(geometry, discretization, cell.parent, np.array(coords))
+            for key, val in coeffs.items():
+                interpolation[geometry.vertex_idx_to_data_idx[vert], geometry.vertex_idx_to_data_idx[key]] = val
+    return interpolation.tocsc()
+
+
+def assert_same(a, b):
+    assert a.shape == b.shape
+    difference = (a - b).tocoo()
+    assert difference.nnz == 0 or np.abs(difference.data).max() == 0
+    # The notebooks store the zero weights of the parent's far corners, too.
+    assert a.nnz == sp.csr_matrix(b.toarray()).nnz
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("dirichlet", list(DIRICHLET))
+def test_transfer_operators_match_notebook(dirichlet, compact):
+    geometry = geo.Geometry(4, DIRICHLET[dirichlet], compact=compact)
+    reference_geometry = geometry if not compact else geo.Geometry(4, DIRICHLET[dirichlet])
+    for level_coarse in range(4):
+        reference = notebook_interpolation(reference_geometry, level_coarse)
+        assert_same(mg.make_interpolation(geometry, level_coarse), reference)
+        assert_same(mg.make_restriction(geometry, level_coarse), reference.T)
+
+
+@pytest.mark.parametrize("dirichlet", list(DIRICHLET))
+def test_storage_matches_notebook(dirichlet):
+    level = 4
+    geometry = geo.Geometry(level, DIRICHLET[dirichlet])
+    discretization = fem.Discretization(geometry, level, lambda x, y: x + y + 0.001)
+    stiffness = discretization.setup_stiffness()
+    storage = mg.MultigridStorage(discretization, 1, level, stiffness)
+
+    # The Galerkin products of the notebook's MultigridStorage
+    reference = stiffness
+    for level_index in range(level - 2, -1, -1):
+        interpolation = notebook_interpolation(geometry, level_coarse=level_index + 1)
+        reference = interpolation.T * reference * interpolation
+        assert np.abs(storage.stiffness[level_index] - reference).max() < 1e-12
+
+    rhs = discretization.setup_rhs()
+    unknowns, cycles = mg.multigrid(storage, rhs, tolerance=1e-8)
+    assert cycles < 20
+    assert mg.compute_residual(stiffness, unknowns, rhs) < 1e-8
+
+
+def test_hierarchy_of_lazy_geometry():
+    # The levels of a lazy geometry are built on first use, the transfer
+    # operators must not read the grid before that.
+    is_dirichlet = DIRICHLET["top and left"]
+    eval_k = lambda x, y: 1.0 + x * y
+    lazy = mg.build_hierarchy(geo.Geometry(4, is_dirichlet, lazy=True), 0, 4, eval_k)
+    reference = mg.build_hierarchy(geo.Geometry(4, is_dirichlet, compact=True), 0, 4, eval_k)
+    for a, b in zip(lazy.operators, reference.operators):
+        assert_same(a, b)
+    for a, b in zip(lazy.prolongations[1:], reference.prolongations[1:]):
+        assert_same(a, b)
+
+
+def test_refill_leaf_stiffness():
+    geometry = geo.Geometry(2, DIRICHLET["top and left"])
+    refined = geometry.refine(list(geometry.grid.dfs(only_level=2))[:3])
+    geometry.refine(refined[:2])
+    discretization = fem.Discretization(geometry, None, lambda x, y: 1.0 + x * y)
+    for useDir in (False, True):
+        assert_same(discretization.refill_stiffness(useDir), discretization.setup_stiffness(useDir))
+    with pytest.raises(ValueError):
+        discretization.refill_stiffness(out=discretization.setup_stiffness())